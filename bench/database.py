@@ -0,0 +1,159 @@
+# Database concurrency benchmark
+#
+# Two cases of concurrent writers, each with the tuned database and the batched writes of the bot, with one
+# transaction per write on the tuned database, and with the SQLite defaults and a commit per write as the
+# bot wrote before. Failed writes (e.g. "database is locked") are counted.
+#
+# registration: `--chats` chats register from `--threads` threads, like concurrent /start commands; batched
+# through the `WriteBatcher`.
+# state: `--feeds` feeds save `--polls` polls of `--entries` seen entries each (`Feed.commit`), from a thread
+# each, while the outbox delivers a post to the registered chats (`Outbox.flush`); batched is a transaction
+# per poll and per outbox batch, per write a transaction per entry and per delivered chat.
+#
+#   python bench/database.py --chats 2000 --threads 16 --feeds 16 --polls 20 --entries 50
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run import REPO
+
+sys.path.insert(0, REPO)
+from peewee import SqliteDatabase
+from database import WriteBatcher, open_database
+from delivery import DeliveryEngine
+from plugins.parser.rss import plugin
+import models
+import outbox as outbox_module
+from models import Chatdb
+
+MODES = ('batched', 'per_write', 'default')
+
+
+def register(chat_id: int):
+    """The writes of /start, see `register_chat` in main.py"""
+    registered = Chatdb.get_or_none(Chatdb.id == chat_id)
+    if registered is None:
+        Chatdb.create(id=chat_id, type='private', first_name=f'user {chat_id}', members_count=1, members_updated=datetime.now())
+    elif not registered.active:
+        Chatdb.update(active=True).where(Chatdb.id == chat_id).execute()
+
+
+def open_bench_database(args, name: str, directory: str):
+    path = os.path.join(directory, f'{name}.sqlite')
+    db = SqliteDatabase(path, timeout=args.timeout) if name == 'default' else open_database(path, timeout=args.timeout)
+    for module in (models, outbox_module, plugin):
+        module.db_proxy.initialize(db)
+    db.create_tables(models.db_tables + outbox_module.db_tables + plugin.db_tables)
+    return db
+
+
+def run_threads(threads: int, function, items) -> int:
+    """Runs `function(item)` for every item, returns the number of failed calls"""
+    with ThreadPoolExecutor(threads) as pool:
+        return sum(future.exception() is not None for future in [pool.submit(function, item) for item in items])
+
+
+def measure_registration(args, name: str, directory: str) -> dict:
+    db = open_bench_database(args, name, directory)
+    writer = WriteBatcher(db)
+    if name == 'batched':
+        writer.start()
+
+    def write(chat_id: int):
+        if name == 'batched':
+            writer.run(register, chat_id)
+        elif name == 'per_write':
+            with db.atomic('IMMEDIATE'):
+                register(chat_id)
+        else:
+            register(chat_id)
+
+    started = monotonic()
+    failed = run_threads(args.threads, write, range(args.chats))
+    seconds = monotonic() - started
+    registered = Chatdb.select().count()
+    db.close()
+    return {'seconds': round(seconds, 3), 'per_second': round(args.chats / seconds), 'failed': failed, 'registered': registered}
+
+
+def measure_state(args, name: str, directory: str) -> dict:
+    db = open_bench_database(args, name, directory)
+    Chatdb.insert_many([{'id': i, 'type': 'private'} for i in range(args.chats)]).execute()
+    parser = plugin.Parser({'sources': [f'https://example.com/{i}.xml' for i in range(args.feeds)]})
+    parser.render_pool.shutdown()
+    # no Bot API, just the outbox writes are measured
+    engine = DeliveryEngine(lambda message, chat_id: None, workers=4, global_rate=1e6, chat_rate=1e6)
+    outbox = outbox_module.Outbox(db, engine, Chatdb, batch_size=1000 if name == 'batched' else 1)
+    with db.atomic():
+        outbox.enqueue(['message'])
+
+    def poll(feed):
+        for poll in range(args.polls):
+            now = datetime.now()
+            rows = [{'feed': feed.properties.id, 'key': poll * args.entries + i, 'content_hash': i, 'seen': now}
+                    for i in range(args.entries)]
+            # the rows a poll leaves for `commit`, all at once or one by one
+            for chunk in [rows] if name == 'batched' else [[row] for row in rows]:
+                feed._seen, feed._finished = chunk, True
+                if name == 'default':
+                    feed.commit()
+                else:
+                    with db.atomic():
+                        feed.commit()
+
+    def drain():
+        outbox.drain()
+        return monotonic() - started
+
+    started = monotonic()
+    with ThreadPoolExecutor(1) as drainer:
+        drained = drainer.submit(drain)
+        failed = run_threads(args.feeds, poll, parser.feeds)
+        feeds_seconds = monotonic() - started
+        failed += drained.exception() is not None
+    seconds = monotonic() - started
+    drain_seconds = drained.result() if drained.exception() is None else seconds
+    engine.stop()
+    entries = plugin.RSS_reader_Entry.select().count()
+    delivered = args.chats - outbox_module.OutboxEntry.select().count()
+    db.close()
+    return {
+        'seconds': round(seconds, 3),
+        'entries_per_second': round(entries / feeds_seconds),
+        'outbox_rows_per_second': round(delivered / drain_seconds),
+        'failed': failed,
+        'entries': entries,
+        'delivered': delivered,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent writes against SQLite')
+    parser.add_argument('--case', choices=('registration', 'state', 'all'), default='all')
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16, help='threads registering chats')
+    parser.add_argument('--feeds', type=int, default=16, help='feeds saving polls concurrently')
+    parser.add_argument('--polls', type=int, default=20, help='polls of every feed')
+    parser.add_argument('--entries', type=int, default=50, help='seen entries saved by a poll')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds a writer waits for the lock')
+    args = parser.parse_args()
+    logging.getLogger('RSS-reader').setLevel(logging.ERROR)     # every feed is a new source
+    result = {'chats': args.chats, 'threads': args.threads, 'feeds': args.feeds, 'polls': args.polls, 'entries': args.entries}
+    cases = {'registration': measure_registration, 'state': measure_state}
+    with tempfile.TemporaryDirectory() as directory:
+        for case, measure in cases.items():
+            if args.case in (case, 'all'):
+                os.mkdir(os.path.join(directory, case))
+                result[case] = {name: measure(args, name, os.path.join(directory, case)) for name in MODES}
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Fixture RSS server for benchmarks
+#
+# Serves one generated feed at /feed.xml. `publish` adds entries, the time of the last publish is the
+# start of the delivery latency. Images of the entries are served at /img/ for media checks.
+# With `conditional` the feed has an ETag and If-None-Match requests of an unchanged feed get 304.
+from html import escape
+from http.server import BaseHTTPRequestHandler
+from threading import Lock, Thread
+from time import monotonic, sleep
+from fake_telegram import Server
+
+
+class FakeRSS:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, paragraphs: int = 3, images: int = 0, size: int = 50,
+                 conditional: bool = False, probe_latency: float = 0):
+        """
+        Every entry has `paragraphs` paragraphs of text and `images` images, the feed keeps `size` entries.
+        Media checks (HEAD requests) take `probe_latency` seconds.
+        """
+        self.paragraphs = paragraphs
+        self.images = images
+        self.size = size
+        self.conditional = conditional
+        self.probe_latency = probe_latency
+        self.entries = 0
+        self.fetches = 0
+        self.not_modified = 0       # fetches answered with 304
+        self.bytes_sent = 0         # feed bodies
+        self.connections = 0
+        self.published = None       # monotonic time of the last publish
+        self._lock = Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True     # headers and body are separate writes
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                if self.path.startswith('/img/'):
+                    self._answer(b'', 'image/jpeg')
+                    return
+                with fake._lock:
+                    fake.fetches += 1
+                    etag = f'"{fake.entries}"'
+                    if fake.conditional and self.headers.get('If-None-Match') == etag:
+                        fake.not_modified += 1
+                        body = None
+                    else:
+                        body = fake.feed().encode()
+                        fake.bytes_sent += len(body)
+                if body is None:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self._answer(body, 'application/rss+xml', {'ETag': etag} if fake.conditional else {})
+
+            def do_HEAD(self):
+                if fake.probe_latency:
+                    sleep(fake.probe_latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', '1000')
+                self.end_headers()
+
+            def _answer(self, body: bytes, content_type: str, headers: dict = {}):
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = Server((host, port), Handler)
+        self.url = f'http://{host}:{self.server.server_port}'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, name='fake-rss', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def publish(self, count: int = 1):
+        with self._lock:
+            self.entries += count
+            self.published = monotonic()
+
+    def _entry(self, i: int) -> str:
+        text = ''.join(f'<p>Paragraph {p} of post {i}, <b>some</b> <i>formatted</i> text and a <a href="{self.url}/post/{i}">link</a>.</p>'
+                       for p in range(self.paragraphs))
+        images = ''.join(f'<img src="{self.url}/img/{i}-{n}.jpg">' for n in range(self.images))
+        return (f'<item><guid>{self.url}/post/{i}</guid><title>Post {i}</title><link>{self.url}/post/{i}</link>'
+                f'<description>{escape(text + images)}</description></item>')
+
+    def feed(self) -> str:
+        items = ''.join(self._entry(i) for i in range(self.entries, max(self.entries - self.size, 0), -1))
+        return f'<?xml version="1.0"?><rss version="2.0"><channel><title>bench</title><link>{self.url}</link>{items}</channel></rss>'
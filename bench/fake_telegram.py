@@ -0,0 +1,133 @@
+# Stand-in Bot API server for benchmarks
+#
+# Answers the methods the bot uses, records every send with its arrival time and can add latency
+# and "429 Too Many Requests" answers, so delivery can be measured without Telegram.
+# Every send is recorded with a key of its content, the same for a media sent by URL or by its file_id.
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+
+SEND_METHODS = ('sendMessage', 'sendPhoto', 'sendVideo', 'sendMediaGroup')
+
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024   # the default listen backlog of 5 resets connections of concurrent senders
+
+
+class FakeTelegram:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0, rate_429: float = 0, retry_after: int = 1):
+        """
+        Every request waits `latency` seconds, a `rate_429` fraction of sends is answered with
+        retry_after (the same chat's retry is not refused again).
+        """
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.sends = list()         # (monotonic time, method, chat id, content key)
+        self.refused = 0
+        self.first_update = None    # monotonic time of the first getUpdates, the bot answers commands from then on
+        self._lock = Lock()
+        self._message_id = 0
+        self._refused_chats = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True     # headers and body are separate writes
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                status, answer = fake.handle(method, body, self.headers.get('Content-Type', ''))
+                data = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = Server((host, port), Handler)
+        self.url = f'http://{host}:{self.server.server_port}'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _params(self, body: bytes, content_type: str) -> dict:
+        if body and 'json' in content_type:
+            return json.loads(body)
+        return {}   # form encoded requests (getUpdates, ...) aren't needed
+
+    def handle(self, method: str, body: bytes, content_type: str):
+        if method == 'getUpdates':
+            if self.first_update is None:
+                self.first_update = monotonic()
+            sleep(0.5)      # a short long-poll
+            return 200, {'ok': True, 'result': []}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}}
+        if method == 'getChatMemberCount':
+            return 200, {'ok': True, 'result': 2}
+        if method not in SEND_METHODS:
+            return 200, {'ok': True, 'result': True}
+
+        if self.latency:
+            sleep(self.latency)
+        params = self._params(body, content_type)
+        chat_id = params.get('chat_id')
+        with self._lock:
+            if self.rate_429 and chat_id not in self._refused_chats and random.random() < self.rate_429:
+                self._refused_chats.add(chat_id)
+                self.refused += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                             'parameters': {'retry_after': self.retry_after}}
+            self._refused_chats.discard(chat_id)
+            self.sends.append((monotonic(), method, chat_id, self._content_key(method, params)))
+            self._message_id += 1
+            message_id = self._message_id
+        return 200, {'ok': True, 'result': self._result(method, params, chat_id, message_id)}
+
+    @staticmethod
+    def _media_key(kind: str, media: str) -> str:
+        """file_ids given by `_result` are the keys of their URLs"""
+        return media if media.startswith(f'{kind}-') else f'{kind}-{hash(media)}'
+
+    @classmethod
+    def _content_key(cls, method: str, params: dict) -> tuple:
+        if method == 'sendMessage':
+            return method, params.get('text')
+        if method == 'sendMediaGroup':
+            return method, tuple(cls._media_key(media['type'], media['media']) for media in params.get('media', []))
+        kind = 'photo' if method == 'sendPhoto' else 'video'
+        return method, cls._media_key(kind, params.get(kind, '')), params.get('caption')
+
+    @staticmethod
+    def _result(method: str, params: dict, chat_id, message_id: int):
+        message = {'message_id': message_id, 'date': int(time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendMessage':
+            return dict(message, text=params.get('text', ''))
+        if method == 'sendPhoto':
+            return dict(message, photo=[{'file_id': f'photo-{hash(params.get("photo"))}', 'file_unique_id': 'p', 'width': 1, 'height': 1}])
+        if method == 'sendVideo':
+            return dict(message, video={'file_id': f'video-{hash(params.get("video"))}', 'file_unique_id': 'v', 'width': 1, 'height': 1, 'duration': 1})
+        items = list()
+        for i, media in enumerate(params.get('media', [])):
+            item = dict(message, message_id=message_id * 100 + i)
+            if media['type'] == 'photo':
+                item['photo'] = [{'file_id': f'photo-{hash(media["media"])}', 'file_unique_id': 'p', 'width': 1, 'height': 1}]
+            else:
+                item['video'] = {'file_id': f'video-{hash(media["media"])}', 'file_unique_id': 'v', 'width': 1, 'height': 1, 'duration': 1}
+            items.append(item)
+        return items
@@ -0,0 +1,82 @@
+# Time to first delivery benchmark
+#
+# Publishes `--posts` new entries to a fake feed whose media checks take `--probe-latency` seconds, then polls
+# it with the RSS plugin and measures when the first post is ready to be queued. Posts streamed by
+# `Feed.iter_posts` (rendered by the render pool, queued one by one) are compared with rendering the
+# posts one by one and queueing them when all are rendered, as the bot did before:
+#
+#   python bench/first_delivery.py --posts 18 --probe-latency 0.1
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_rss import FakeRSS
+from run import REPO
+
+sys.path.insert(0, REPO)
+from database import open_database
+from plugins.parser.rss import plugin
+
+
+def measure(args, name: str, directory: str) -> dict:
+    rss = FakeRSS(images=args.images, probe_latency=args.probe_latency).start()
+    db = open_database(os.path.join(directory, f'{name}.sqlite'))
+    plugin.db_proxy.initialize(db)
+    db.create_tables(plugin.db_tables)
+    parser = plugin.Parser({
+        'source': f'{rss.url}/feed.xml',
+        'post-template': '<a href="{feed[link]}">{feed[title]}</a>\n\n{feed[content]}',
+        # rendering one post at a time, and all of them before the first is taken
+        'render-workers': args.render_workers if name == 'streamed' else 1,
+        'render-ahead': 8 if name == 'streamed' else args.posts,
+    })
+    feed = parser.feeds[0]
+    try:
+        # the first poll of a new source just saves its entries
+        rss.publish(1)
+        with db.atomic():
+            feed.new_posts()
+        rss.publish(args.posts)
+
+        started = monotonic()
+        first = None
+        posts = 0
+        with db.atomic():
+            if name == 'streamed':
+                for messages in feed.iter_posts():
+                    if first is None:
+                        first = monotonic() - started
+                    posts += 1
+                feed.commit()
+            else:
+                rendered = list(feed.iter_posts())
+                first = monotonic() - started
+                posts = len(rendered)
+                feed.commit()
+        return {'posts': posts, 'first_post': round(first, 3), 'all_posts': round(monotonic() - started, 3)}
+    finally:
+        parser.render_pool.shutdown()
+        db.close()
+        rss.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time until the first new post of a poll is ready to be queued')
+    parser.add_argument('--posts', type=int, default=18)
+    parser.add_argument('--images', type=int, default=1, help='images of every post')
+    parser.add_argument('--probe-latency', type=float, default=0.1, help='seconds of each media check')
+    parser.add_argument('--render-workers', type=int, default=4)
+    args = parser.parse_args()
+    result = {'posts': args.posts, 'probe_latency': args.probe_latency, 'render_workers': args.render_workers}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('streamed', 'all_first'):
+            result[name] = measure(args, name, directory)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
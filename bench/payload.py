@@ -0,0 +1,76 @@
+# Per-send CPU cost benchmark
+#
+# Sends one photo message with an inline keyboard to `--chats` chats through a Bot API transport that
+# answers right away, so just the CPU cost of each send is measured. The cached payload of the message
+# (`MessageModel.payload`) is compared with building the request for every chat as the bot did before,
+# `bot.send_photo(chat_id, **message.to_dict())`:
+#
+#   python bench/payload.py --chats 10000
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run import REPO
+
+sys.path.insert(0, REPO)
+from telegram import Bot, InlineKeyboardButton, ParseMode
+from telegram.utils.request import Request
+from plugins.parser.model import PhotoMessage
+from sender import Sender
+
+RESULT = json.dumps({'ok': True, 'result': {
+    'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+    'photo': [{'file_id': 'file', 'file_unique_id': 'unique', 'width': 90, 'height': 90}],
+}}).encode()
+
+
+class InstantRequest(Request):
+    """Answers every request with a sent photo without any network I/O"""
+
+    def _request_wrapper(self, *args, **kwargs):
+        return RESULT
+
+
+def new_message() -> PhotoMessage:
+    return PhotoMessage('https://example.com/image.jpg', text='<b>Post title</b>\n\nA caption of the post',
+                        parse_mode=ParseMode.HTML, inline_keyboard=[
+                            [InlineKeyboardButton('Open image link', url='https://example.com/image-full.jpg')],
+                            [InlineKeyboardButton('Read more', url='https://example.com/post')],
+                        ])
+
+
+def per_send(function, chats: int) -> float:
+    """Microseconds per send"""
+    started = perf_counter()
+    for chat_id in range(chats):
+        function(chat_id)
+    return round((perf_counter() - started) / chats * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU cost of sending one message to many chats')
+    parser.add_argument('--chats', type=int, default=10000)
+    args = parser.parse_args()
+    bot = Bot('123:bench', request=InstantRequest())
+    sender = Sender(bot, None)
+
+    message = new_message()
+    payload_send = lambda chat_id: sender.request(message.payload().method, message.payload().for_chat(chat_id))
+    to_dict_send = lambda chat_id: bot.send_photo(chat_id, **message.to_dict())
+    # just building the request body, without the transport and parsing the answer
+    payload_build = lambda chat_id: message.payload().for_chat(chat_id)
+    to_dict_build = lambda chat_id: json.dumps({'chat_id': chat_id, **{k: v.to_json() if k == 'reply_markup' else v
+                                                                      for k, v in message.to_dict().items() if v is not None}})
+    result = {'chats': args.chats}
+    for name, function in (('payload', payload_build), ('to_dict', to_dict_build)):
+        result[f'{name}_build_us'] = per_send(function, args.chats)
+    for name, function in (('payload', payload_send), ('to_dict', to_dict_send)):
+        result[f'{name}_send_us'] = per_send(function, args.chats)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# RSS polling benchmark
+#
+# Polls a fake feed with the RSS parser plugin and counts what each poll costs: feed bytes downloaded,
+# connections opened and feeds parsed. A new entry is published every `--change-every` polls. The plugin
+# is measured against a server with ETag support and one without (the body hash skips the parse), and
+# against plain downloads with a new connection and a parse every poll, as the plugin polled before:
+#
+#   python bench/rss_polling.py --polls 50 --change-every 10
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_rss import FakeRSS
+from run import REPO
+
+sys.path.insert(0, REPO)
+import feedparser
+import requests
+from database import open_database
+from plugins.parser.rss import plugin
+
+
+PARSE = feedparser.parse
+
+
+def counting_parse():
+    """Counts the calls of feedparser.parse"""
+    def wrapper(*args, **kwargs):
+        wrapper.calls += 1
+        return PARSE(*args, **kwargs)
+    wrapper.calls = 0
+    feedparser.parse = wrapper
+    return wrapper
+
+
+def poll_plugin(args, rss: FakeRSS, directory: str) -> int:
+    db = open_database(os.path.join(directory, f'polling-{rss.conditional}.sqlite'))
+    plugin.db_proxy.initialize(db)
+    db.create_tables(plugin.db_tables)
+    parser = plugin.Parser({'source': f'{rss.url}/feed.xml', 'post-template': '<a href="{feed[link]}">{feed[title]}</a>\n\n{feed[content]}'})
+    feed = parser.feeds[0]
+    posts = 0
+    for poll in range(args.polls):
+        if poll and poll % args.change_every == 0:
+            rss.publish(1)
+        with db.atomic():
+            posts += len(feed.new_posts())
+    parser.render_pool.shutdown()
+    db.close()
+    return posts
+
+
+def poll_plain(args, rss: FakeRSS) -> int:
+    entries = set()
+    posts = 0
+    for poll in range(args.polls):
+        if poll and poll % args.change_every == 0:
+            rss.publish(1)
+        feeds = feedparser.parse(requests.get(f'{rss.url}/feed.xml', timeout=30).content)
+        new = [entry.id for entry in feeds.entries if entry.id not in entries]
+        if entries:
+            posts += len(new)
+        entries.update(new)
+    return posts
+
+
+def measure(args, name: str, directory: str) -> dict:
+    rss = FakeRSS(conditional=name == 'etag', size=args.size, paragraphs=args.paragraphs).start()
+    rss.publish(args.size)
+    parse = counting_parse()
+    started = monotonic()
+    try:
+        posts = poll_plain(args, rss) if name == 'plain' else poll_plugin(args, rss, directory)
+    finally:
+        feedparser.parse = PARSE
+        rss.stop()
+    return {
+        'seconds': round(monotonic() - started, 3),
+        'posts': posts,
+        'feed_bytes': rss.bytes_sent,
+        'not_modified': rss.not_modified,
+        'connections': rss.connections,
+        'parses': parse.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of RSS polls against a fake feed server')
+    parser.add_argument('--polls', type=int, default=50)
+    parser.add_argument('--change-every', type=int, default=10, help='polls between new entries')
+    parser.add_argument('--size', type=int, default=50, help='entries in the feed')
+    parser.add_argument('--paragraphs', type=int, default=3)
+    args = parser.parse_args()
+    result = {'polls': args.polls, 'change_every': args.change_every, 'size': args.size}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('etag', 'no_etag', 'plain'):
+            result[name] = measure(args, name, directory)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
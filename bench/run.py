@@ -0,0 +1,214 @@
+# End to end delivery benchmark
+#
+# Runs the bot (main.py) as a subprocess against the fake Bot API and RSS servers, registers the chats in
+# its database, publishes posts and measures their fan-out:
+#
+#   python bench/run.py --chats 1000 --posts 5 --latency 0.02 --rate-429 0.01
+import argparse
+import json
+import logging
+import os
+import resource
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from time import monotonic, sleep
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_rss import FakeRSS
+from fake_telegram import FakeTelegram
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POST_TEMPLATE = '<a href="{feed[link]}">{feed[title]}</a>\n\n{feed[content]}'
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def wait_for(condition: callable, timeout: float, what: str, process: subprocess.Popen = None):
+    deadline = monotonic() + timeout
+    while not condition():
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'bot exited with {process.returncode} while waiting for {what}')
+        if monotonic() > deadline:
+            raise TimeoutError(f'timed out waiting for {what}')
+        sleep(0.05)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def failed_requests(metrics_port: int) -> int:
+    """Bot API sends of the bot that failed (connection errors, error answers but 429), from its metrics"""
+    failed = 0
+    with urlopen(f'http://127.0.0.1:{metrics_port}/metrics', timeout=10) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith('bot_api_requests_total{') and 'result="ok"' not in line and 'result="RetryAfter"' not in line:
+                failed += int(float(line.rsplit(' ', 1)[1]))
+    return failed
+
+
+def write_config(directory: str, args, telegram: FakeTelegram, rss: FakeRSS, metrics_port: int) -> str:
+    config = {
+        'token': '123:bench',
+        'telegram-token': '123:bench',
+        'bot-api-url': telegram.url,
+        'database': os.path.join(directory, 'bench.sqlite'),
+        'log-level': args.log_level,
+        'runtime': args.runtime,
+        'delivery': {'workers': args.workers, 'global-rate': args.global_rate, 'chat-rate': args.chat_rate, 'report-interval': 5,
+                     'processes': args.processes, 'lease-ttl': 20},
+        'member-counts': {'interval': 3600, 'max-age': 10 ** 9},
+        'metrics': {'enabled': True, 'port': metrics_port},
+        'parser': 'rss',
+        'parser-config': {
+            'sources': [{'source': f'{rss.url}/feed.xml', 'interval': args.poll_interval}],
+            'post-template': POST_TEMPLATE,
+        },
+    }
+    with open(os.path.join(directory, 'config.jsonc'), 'w') as file:
+        json.dump(config, file)
+    return config['database']
+
+
+def rendered_messages(rss: FakeRSS, posts: int) -> int:
+    """Messages of the last `posts` published entries, rendered by the RSS plugin like the bot does"""
+    sys.path.insert(0, REPO)
+    import feedparser
+    from peewee import SqliteDatabase
+    from plugins.parser.rss import plugin
+    db = SqliteDatabase(':memory:')     # the plugin wants its state tables, the bot has its own database
+    plugin.db_proxy.initialize(db)
+    db.create_tables(plugin.db_tables)
+    logging.getLogger('RSS-reader').disabled = True      # "new source" warnings
+    parser = plugin.Parser({'source': f'{rss.url}/feed.xml', 'post-template': POST_TEMPLATE})
+    try:
+        return sum(len(parser.render_post(entry)) for entry in feedparser.parse(rss.feed()).entries[:posts])
+    finally:
+        parser.render_pool.shutdown()
+        db.close()
+
+
+def register_chats(database: str, count: int):
+    """Subscribers are inserted directly, the bot has created its tables when it polled the first time"""
+    connection = sqlite3.connect(database, timeout=30)
+    with connection:
+        connection.executemany(
+            'INSERT INTO chatdb (id, type, members_count, active) VALUES (?, ?, 1, 1)',
+            ((1000000 + i, 'private') for i in range(count)))
+    connection.close()
+
+
+def run(args) -> dict:
+    telegram = FakeTelegram(latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after).start()
+    rss = FakeRSS(paragraphs=args.paragraphs, images=args.images).start()
+    rss.publish(5)      # the first poll of a source just remembers its entries
+
+    with tempfile.TemporaryDirectory() as directory:
+        metrics_port = free_port()
+        database = write_config(directory, args, telegram, rss, metrics_port)
+        log_path = os.path.join(directory, 'bot.log')
+        with open(log_path, 'w') as log:
+            started = monotonic()
+            process = subprocess.Popen([sys.executable, os.path.join(REPO, 'main.py')], cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                # the second fetch means the first poll is committed
+                wait_for(lambda: rss.fetches >= 2, args.timeout, 'the first polls', process)
+                startup = monotonic() - started
+                register_chats(database, args.chats)
+
+                rss.publish(args.posts)
+                published = rss.published
+                per_chat = rendered_messages(rss, args.posts)
+                # done when nothing was sent for `idle` seconds
+                last_count, last_change = 0, monotonic()
+                while monotonic() - last_change < args.idle or not telegram.sends:
+                    if process.poll() is not None:
+                        raise RuntimeError(f'bot exited with {process.returncode}')
+                    if monotonic() - published > args.timeout:
+                        raise TimeoutError('timed out waiting for the delivery')
+                    if len(telegram.sends) != last_count:
+                        last_count, last_change = len(telegram.sends), monotonic()
+                    sleep(0.1)
+                failed = failed_requests(metrics_port)
+            except Exception:
+                with open(log_path) as file:
+                    sys.stderr.write(file.read()[-5000:])
+                raise
+            finally:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    telegram.stop()
+    rss.stop()
+    times = [sent for sent, method, chat_id, key in telegram.sends]
+    latencies = [sent - published for sent in times]
+    duration = max(times) - min(times)
+    # every chat gets every message of the published posts once
+    expected = args.chats * per_chat
+    deliveries = Counter((chat_id, key) for sent, method, chat_id, key in telegram.sends)
+    duplicates = len(times) - len(deliveries)
+    complete = len(deliveries) == expected
+    if not complete:
+        sys.stderr.write(f'Incomplete run: {len(deliveries)} distinct messages arrived, {expected} expected ({failed} requests failed), '
+                         'throughput and latency are left out\n')
+    if duplicates:
+        sys.stderr.write(f'{duplicates} messages arrived more than once\n')
+    return {
+        'chats': args.chats,
+        'posts': args.posts,
+        'sends': len(times),
+        'expected_sends': expected,
+        'duplicates': duplicates,
+        'failed_requests': failed,
+        'refused_429': telegram.refused,
+        'complete': complete,
+        'startup_seconds': round(startup, 3),
+        'messages_per_second': round(len(times) / duration, 1) if duration and complete else None,
+        'latency_p50': round(percentile(latencies, 0.5), 3) if complete else None,
+        'latency_p99': round(percentile(latencies, 0.99), 3) if complete else None,
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+        'peak_memory_mb': round(usage.ru_maxrss / 1024, 1),     # ru_maxrss is KiB on Linux
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end delivery benchmark against fake Bot API and RSS servers')
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=3)
+    parser.add_argument('--paragraphs', type=int, default=3, help='paragraphs of text in every post')
+    parser.add_argument('--images', type=int, default=0, help='images in every post')
+    parser.add_argument('--latency', type=float, default=0, help='seconds the fake Bot API takes to answer')
+    parser.add_argument('--rate-429', type=float, default=0, help='fraction of sends refused with retry_after')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--runtime', choices=('threads', 'async'), default='threads')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=1, help='delivery processes, see delivery.processes')
+    parser.add_argument('--global-rate', type=float, default=10000, help='the real limit is 30, the default measures the bot itself')
+    parser.add_argument('--chat-rate', type=float, default=1)
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--idle', type=float, default=3, help='seconds without sends that end the run')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--log-level', default='warning')
+    print(json.dumps(run(parser.parse_args()), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Sanitizer benchmark
+#
+# Times the streaming sanitizer and the rendering of its fragments to messages on a large generated post,
+# and the BeautifulSoup purge the plugin used before it (purge the tree, then split the HTML around each
+# media and parse the text between them again) when bs4 is installed:
+#
+#   python bench/sanitizer.py --paragraphs 200 --images 2000
+import argparse
+import json
+import os
+import sys
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run import REPO
+
+sys.path.insert(0, REPO)
+from types import SimpleNamespace
+from peewee import SqliteDatabase
+from plugins.parser.rss import plugin
+from plugins.parser.rss.sanitizer import Media, sanitize
+
+
+def generate_post(paragraphs: int, images: int) -> str:
+    parts = list()
+    for i in range(max(paragraphs, images)):
+        if i < paragraphs:
+            parts.append(f'<p class="text">Paragraph {i}, <b>some</b> <span style="color:red">styled</span> '
+                         f'<i>formatted</i> text and a <a href="https://example.com/{i}" rel="nofollow">link</a>.</p>')
+        if i < images:
+            parts.append(f'<div class="figure"><a href="https://example.com/full/{i}.jpg">'
+                         f'<img src="https://example.com/{i}.jpg" width="640" alt="image {i}"></a></div>')
+    return ''.join(parts)
+
+
+def legacy_render(html: str, safe_tags_attrs: dict) -> int:
+    """The purge of the plugin before the streaming sanitizer, returns the number of text parts"""
+    from bs4 import BeautifulSoup as Soup
+
+    def purge(children):
+        for tag in children:
+            if getattr(tag, 'contents', None) is not None:
+                purge(tag.contents)
+                if tag.name not in safe_tags_attrs:
+                    tag.replace_with(''.join(map(str, tag.contents)))
+                else:
+                    attr = safe_tags_attrs[tag.name]
+                    if attr is None:
+                        tag.attrs.clear()
+                    elif isinstance(attr, tuple):
+                        if all(a in tag.attrs for a in attr):
+                            tag.attrs = {a: tag[a] for a in attr}
+                        else:
+                            tag.replace_with(''.join(map(str, tag.contents)))
+                    elif isinstance(attr, list):
+                        tag.attrs = {a: tag[a] for a in attr if a in tag.attrs}
+        return children
+
+    body = Soup(''.join(map(str, purge(Soup(html, 'html.parser').contents))), 'html.parser')
+    parts = 0
+    after = str(body)
+    for media in list(body('img')) + list(body('video')):
+        split_by = str(media.parent) if media.parent.name == 'a' else str(media)
+        before, after = after.split(split_by, 1)
+        if before:
+            Soup(before, 'html.parser')
+            parts += 1
+    return parts
+
+
+def timed(function, repeat: int) -> float:
+    times = list()
+    for _ in range(repeat):
+        started = perf_counter()
+        function()
+        times.append(perf_counter() - started)
+    return round(median(times), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sanitizer and rendering time of a large post')
+    parser.add_argument('--paragraphs', type=int, default=200)
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-legacy', action='store_true', help='skip the BeautifulSoup purge')
+    args = parser.parse_args()
+
+    db = SqliteDatabase(':memory:')
+    plugin.db_proxy.initialize(db)
+    db.create_tables(plugin.db_tables)
+    rss = plugin.Parser({'source': 'https://example.com/feed.xml', 'post-template': '{feed[content]}'})
+    html = generate_post(args.paragraphs, args.images)
+    post = SimpleNamespace(title='bench', description=html, link='https://example.com/post')
+    fragments = sanitize(html, rss.SAFE_TAGS_ATTRS)
+
+    result = {
+        'post_bytes': len(html.encode()),
+        'fragments': len(fragments),
+        'media': sum(isinstance(f, Media) for f in fragments),
+        'sanitize_seconds': timed(lambda: sanitize(html, rss.SAFE_TAGS_ATTRS), args.repeat),
+        # media checks are left out, they are network bound
+        'render_seconds': timed(lambda: rss.render_fragments(rss.prepare_post(post), post.link, {}), args.repeat),
+    }
+    if not args.no_legacy:
+        try:
+            result['legacy_seconds'] = timed(lambda: legacy_render(html, rss.SAFE_TAGS_ATTRS), 1)
+        except ImportError:
+            result['legacy_seconds'] = None     # bs4 is not installed
+    rss.render_pool.shutdown()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
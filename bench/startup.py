@@ -0,0 +1,90 @@
+# Startup time benchmark
+#
+# Starts the bot (main.py) repeatedly against the fake Bot API and RSS servers and measures the time until
+# it asks for updates, i.e. until it answers commands, and until the first poll of its sources:
+#
+#   python bench/startup.py --runs 5 --sources 50
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_rss import FakeRSS
+from fake_telegram import FakeTelegram
+from run import REPO, wait_for
+
+
+def start_once(args, warm: bool) -> dict:
+    telegram = FakeTelegram().start()
+    rss = FakeRSS().start()
+    rss.publish(5)
+    directory = args.directory
+    config = {
+        'telegram-token': '123:bench',
+        'bot-api-url': telegram.url,
+        'database': os.path.join(directory, 'bench.sqlite'),
+        'log-level': args.log_level,
+        'scheduler': {'jitter': 0},     # polls start right away instead of spread over the first interval
+        'parser': 'rss',
+        'parser-config': {
+            # distinct URLs, the fake server ignores the query
+            'sources': [{'source': f'{rss.url}/feed.xml?{i}', 'interval': 3600} for i in range(args.sources)],
+        },
+    }
+    with open(os.path.join(directory, 'config.jsonc'), 'w') as file:
+        json.dump(config, file)
+    if not warm and os.path.exists(config['database']):
+        os.remove(config['database'])
+
+    started = monotonic()
+    with open(os.path.join(directory, 'bot.log'), 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(REPO, 'main.py')], cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for(lambda: telegram.first_update is not None, args.timeout, 'getUpdates', process)
+        wait_for(lambda: rss.fetches >= 1, args.timeout, 'the first poll', process)
+        return {'responsive': telegram.first_update - started, 'first_poll': monotonic() - started}
+    except Exception:
+        with open(os.path.join(directory, 'bot.log')) as file:
+            sys.stderr.write(file.read()[-5000:])
+        raise
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        telegram.stop()
+        rss.stop()
+
+
+def summary(runs: list, key: str) -> dict:
+    values = [run[key] for run in runs]
+    return {'min': round(min(values), 3), 'median': round(median(values), 3), 'max': round(max(values), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time of the bot against fake Bot API and RSS servers')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--sources', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+    result = {'runs': args.runs, 'sources': args.sources}
+    with tempfile.TemporaryDirectory() as args.directory:
+        # a fresh database, then restarts with the existing one
+        cold = [start_once(args, warm=False) for _ in range(args.runs)]
+        warm = [start_once(args, warm=True) for _ in range(args.runs)]
+    for name, runs in (('cold', cold), ('warm', warm)):
+        result[name] = {key: summary(runs, key) for key in ('responsive', 'first_poll')}
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Database helpers shared by the bot core and plugins
+#
+# The bot uses SQLite from many threads (handlers, polls, delivery). Every thread gets its own connection
+# (peewee keeps connections per thread), WAL lets readers work while one writer commits, and small
+# writes of concurrent handlers are grouped by `WriteBatcher` into one transaction and one disk sync.
+from concurrent.futures import Future
+from logging import getLogger
+from queue import Empty, SimpleQueue
+from threading import Thread
+from peewee import Model, SqliteDatabase
+from playhouse.migrate import SqliteMigrator, migrate
+
+
+def open_database(path: str, cache_size: int = 64000, synchronous: str = 'normal', timeout: float = 30) -> SqliteDatabase:
+    """
+    SQLite database tuned for concurrent use. `cache_size` is in KiB per connection, `timeout` is how
+    many seconds a writer waits for the write lock held by another thread.
+    With WAL, synchronous=normal is still safe from corruption, a power loss may just lose the last commits.
+    """
+    return SqliteDatabase(path, timeout=timeout, pragmas={
+        'journal_mode': 'wal',
+        'synchronous': synchronous,
+        'cache_size': -cache_size,      # negative values are KiB instead of pages
+        'foreign_keys': 1,
+        'temp_store': 'memory',
+    })
+
+
+class WriteBatcher:
+    """
+    Runs writes submitted by many threads in a single writer thread, every batch in one transaction.
+    Each write runs in its own savepoint, so a failing one doesn't roll back the others.
+    """
+
+    def __init__(self, db: SqliteDatabase, max_batch: int = 100):
+        self.db = db
+        self.max_batch = max_batch
+        self.logger = getLogger('database')
+        self._queue = SimpleQueue()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, write: callable, *args) -> Future:
+        """Queue `write(*args)`, the future gets its result when the batch is committed"""
+        future = Future()
+        self._queue.put((future, write, args))
+        return future
+
+    def run(self, write: callable, *args):
+        """Queue `write(*args)` and wait for its result, runs it right away if the writer isn't started"""
+        if self._thread is None:
+            with self.db.atomic():
+                return write(*args)
+        return self.submit(write, *args).result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            results = list()
+            try:
+                # IMMEDIATE takes the write lock at once, a deferred transaction could fail to upgrade its lock
+                with self.db.atomic('IMMEDIATE'):
+                    for future, write, args in batch:
+                        try:
+                            with self.db.atomic():
+                                results.append((future, write(*args), None))
+                        except Exception as e:
+                            results.append((future, None, e))
+            except Exception as e:
+                self.logger.exception('Committing %d writes failed', len(batch))
+                results = [(future, None, e) for future, write, args in batch]
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+
+def add_missing_columns(*models: Model, tables: set = None):
+    """
+    Add columns of fields that were introduced after the tables were created.
+    New fields must be nullable or have a default value. `tables` are the existing tables if known.
+    """
+    for model in models:
+        db = model._meta.database
+        table = model._meta.table_name
+        if table not in (tables if tables is not None else db.get_tables()):
+            continue
+        existing = {column.name for column in db.get_columns(table)}
+        migrator = SqliteMigrator(db.obj if hasattr(db, 'obj') else db)     # unwrap DatabaseProxy
+        operations = [
+            migrator.add_column(table, field.column_name, field)
+            for field in model._meta.sorted_fields
+            if field.column_name not in existing
+        ]
+        if operations:
+            migrate(*operations)
+
+
+def create_schema(db: SqliteDatabase, models: list):
+    """
+    Add missing columns, then create missing tables and indexes, in one transaction: a single commit, and
+    processes starting at the same time don't race on it.
+    """
+    with db.atomic('IMMEDIATE'):
+        add_missing_columns(*models, tables=set(db.get_tables()))
+        db.create_tables(models)    # also creates indexes of new columns
@@ -2,6 +2,8 @@ from telegram import Update
 from telegram.ext import CommandHandler, MessageHandler, Filters, CallbackContext
 from functools import wraps
 from logging import getLogger
+from threading import Lock
+from time import monotonic
 
 class HandlersDecorator(object):
     def __init__(self, dispatcher):
@@ -26,12 +28,49 @@ class HandlersDecorator(object):
             return func
         return wrapper
 
-def Auth(authorized: callable):
+class AuthCache(object):
+    """
+    In-memory {user id: privilege} of authorized users, so checking a user needs no database query.
+    `loader()` returns (id, privilege) pairs, it's called again after `invalidate` or when `ttl` seconds passed.
+    """
+    def __init__(self, loader: callable, ttl: float = None):
+        self.loader = loader
+        self.ttl = ttl
+        self.lock = Lock()
+        self._users = None
+        self._loaded = 0
+        self._generation = 0    # bumped by `invalidate`, a load that overlapped it is not kept
+
+    def __call__(self) -> dict:
+        users = self._users
+        if users is None or (self.ttl is not None and monotonic() - self._loaded > self.ttl):
+            with self.lock:
+                if self._users is None or users is self._users:
+                    while True:
+                        generation = self._generation
+                        loaded = dict(self.loader())
+                        if generation == self._generation:
+                            break
+                    self._loaded = monotonic()
+                    self._users = loaded
+                users = self._users
+        return users
+
+    def invalidate(self):
+        self._generation += 1
+        self._users = None
+
+def Auth(authorized: callable, privilege: int = None):
+    """
+    `authorized()` returns the ids of authorized users, or a {user id: privilege} dict (e.g. an AuthCache).
+    With `privilege` users need at least that privilege.
+    """
     def wrapper(func):
         @wraps(func)
         def wrapped(update: Update, context: CallbackContext):
             user = update.message.from_user
-            if user.id not in authorized():
+            users = authorized()
+            if user.id not in users or (privilege is not None and users[user.id] < privilege):
                 update.message.reply_text("You are not authorized to use this command.")
                 return
             return func(update, context)
@@ -0,0 +1,310 @@
+# Rate-limited concurrent delivery engine
+#
+# Every chat gets its own "lane" (a FIFO of messages). A lane is served by one worker at a time,
+# so messages of a chat are always sent in order, while different chats are served concurrently.
+# Telegram limits are respected with token buckets: a global one (~30 msg/s) shared by all
+# workers and a per-chat one (~1 msg/s) kept by each lane. Network errors are retried with backoff.
+import asyncio
+import heapq
+from collections import deque
+from itertools import count
+from logging import getLogger
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+
+class Resend(Exception):
+    """Raised by `send` when the message must be sent again, it goes through the rate limits again"""
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Connection errors and timeouts, the message may be sent by trying again"""
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def reserve(self) -> float:
+        """Take one token and return how many seconds the caller must wait before using it"""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class _Lane:
+    __slots__ = ('chat_id', 'queue', 'ready_at', 'scheduled', 'attempts')
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.queue = deque()        # (message, job) items
+        self.ready_at = 0           # monotonic time when this chat may receive the next message
+        self.scheduled = False      # True if the lane is in the heap or held by a worker
+        self.attempts = 0           # failed attempts of the message at the head of the queue
+
+
+class _Job:
+    __slots__ = ('remaining', 'callback', 'progress', 'sent', 'failed')
+
+    def __init__(self, remaining, callback, progress):
+        self.remaining = remaining
+        self.callback = callback
+        self.progress = progress
+        self.sent = 0
+        self.failed = None
+
+
+class DeliveryEngine:
+    def __init__(self, send: callable, workers: int = 8, global_rate: float = 30, chat_rate: float = 1, report_interval: float = 10,
+                 retries: int = 5, max_backoff: float = 60):
+        """
+        `send(message, chat_id)` is called from worker threads and must raise on failure.
+        Transient errors are retried `retries` times, waiting 1, 2, 4... (at most `max_backoff`) seconds.
+        """
+        self.send = send
+        self.logger = getLogger('delivery')
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_interval = 1 / chat_rate
+        self.report_interval = report_interval
+        self.retries = retries
+        self.max_backoff = max_backoff
+
+        self._lanes = dict()    # chat_id -> _Lane (only lanes with queued messages)
+        self._heap = list()     # (ready_at, seq, lane)
+        self._seq = count()
+        self._cond = Condition()
+        self._stopped = False
+        self._sending = 0       # lanes held by workers
+
+        self.sent = 0
+        self.failed = 0
+        self.pending = 0        # queued messages not sent yet
+        self.rate = 0.0         # messages/second measured over the last report interval
+
+        self._start(workers)
+        Thread(target=self._monitor, name='delivery-monitor', daemon=True).start()
+
+    def _start(self, workers: int):
+        for i in range(workers):
+            Thread(target=self._worker, name=f'delivery-{i}', daemon=True).start()
+
+    def submit(self, chat_id: int, messages: list, callback: callable = None, progress: callable = None):
+        """
+        Queue `messages` for `chat_id`. When all of them are handled `callback(chat_id, error)` is
+        called from a worker thread, `error` is None on success or the exception that stopped the delivery.
+        `progress(chat_id, sent)` is called after every message sent, with the number sent so far.
+        """
+        if not messages:
+            if callback:
+                callback(chat_id, None)
+            return
+        job = _Job(len(messages), callback, progress)
+        with self._cond:
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                lane = self._lanes[chat_id] = _Lane(chat_id)
+            lane.queue.extend((message, job) for message in messages)
+            self.pending += len(messages)
+            if not lane.scheduled:
+                self._schedule(lane)
+
+    def join(self, max_pending: int = 0):
+        """Block until at most `max_pending` queued messages are left"""
+        with self._cond:
+            while self.pending > max_pending:
+                self._cond.wait()
+
+    def stop(self, timeout: float = None):
+        """Stop sending, waits for the sends in progress. Queued messages are not sent"""
+        with self._cond:
+            self._stopped = True
+            self._wakeup()
+            self._cond.wait_for(lambda: not self._sending, timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'pending': self.pending,
+                'chats': len(self._lanes),
+                'rate': self.rate,
+            }
+
+    def _schedule(self, lane: _Lane):
+        # must be called with self._cond held
+        lane.scheduled = True
+        heapq.heappush(self._heap, (lane.ready_at, next(self._seq), lane))
+        self._wakeup()
+
+    def _wakeup(self):
+        # must be called with self._cond held
+        self._cond.notify_all()
+
+    def _next_lane(self) -> _Lane:
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                lane, wait = self._pop_ready_lane()
+                if lane is not None:
+                    self._sending += 1
+                    return lane
+                self._cond.wait(wait)
+
+    def _pop_ready_lane(self):
+        """Returns (lane, None) for a ready lane or (None, seconds until the next lane is ready)"""
+        # must be called with self._cond held
+        if self._heap:
+            wait = self._heap[0][0] - monotonic()
+            if wait <= 0:
+                return heapq.heappop(self._heap)[2], None
+            return None, wait
+        return None, None
+
+    def _worker(self):
+        while (lane := self._next_lane()) is not None:
+            message, job = lane.queue[0]
+            sleep(self.global_bucket.reserve())
+            error = retry_after = None
+            try:
+                self.send(message, lane.chat_id)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+            except Resend:
+                retry_after = 0
+            except Exception as e:
+                error = e
+            self._done(lane, job, error, retry_after)
+
+    def _done(self, lane: _Lane, job: _Job, error: Exception, retry_after: float):
+        finished = list()
+        sent = None
+        with self._cond:
+            self._sending -= 1
+            now = monotonic()
+            if retry_after is None and is_transient_error(error) and lane.attempts < self.retries:
+                retry_after = min(2 ** lane.attempts, self.max_backoff)
+                lane.attempts += 1
+                self.logger.warning('Sending to chat %d failed (%s), retrying in %s seconds', lane.chat_id, error, retry_after)
+            elif retry_after:
+                self.logger.warning('Flood control for chat %d, retrying in %s seconds', lane.chat_id, retry_after)
+            if retry_after is not None:
+                # Back off just this chat, the message stays at the head of its lane
+                lane.ready_at = now + retry_after
+                self._schedule(lane)
+                self._cond.notify_all()
+                return
+
+            lane.queue.popleft()
+            lane.attempts = 0
+            self.pending -= 1
+            job.remaining -= 1
+            if error is None:
+                self.sent += 1
+                job.sent += 1
+                sent = job.sent
+            else:
+                self.failed += 1
+                self.logger.error('Failed to send message to chat %d: %s', lane.chat_id, error)
+                job.failed = error
+                # Drop the rest of this job, sending them out of order is worse than not sending them
+                while lane.queue and lane.queue[0][1] is job:
+                    lane.queue.popleft()
+                    self.pending -= 1
+                    job.remaining -= 1
+            if job.remaining == 0:
+                finished.append(job)
+
+            if lane.queue:
+                lane.ready_at = now + self.chat_interval
+                self._schedule(lane)
+            else:
+                lane.scheduled = False
+                del self._lanes[lane.chat_id]
+            self._cond.notify_all()
+
+        if sent is not None and job.progress:
+            try:
+                job.progress(lane.chat_id, sent)
+            except Exception:
+                self.logger.exception('Delivery progress callback failed for chat %d', lane.chat_id)
+        for job in finished:
+            if job.callback:
+                try:
+                    job.callback(lane.chat_id, job.failed)
+                except Exception:
+                    self.logger.exception('Delivery callback failed for chat %d', lane.chat_id)
+
+    def _monitor(self):
+        last_sent, last_time = 0, monotonic()
+        while not self._stopped:
+            sleep(self.report_interval)
+            now = monotonic()
+            with self._cond:
+                self.rate = (self.sent - last_sent) / (now - last_time)
+                last_sent, last_time = self.sent, now
+                pending, chats = self.pending, len(self._lanes)
+            if pending or self.rate:
+                self.logger.info('Delivering %.1f msg/s, %d messages queued for %d chats', self.rate, pending, chats)
+
+
+class AsyncDeliveryEngine(DeliveryEngine):
+    """
+    DeliveryEngine whose workers are tasks of an asyncio event loop and `send` is a coroutine function.
+    `submit`, `join` and `stats` can still be called from any thread.
+    """
+
+    def __init__(self, send: callable, loop: asyncio.AbstractEventLoop, **kwargs):
+        self.loop = loop
+        self._event = asyncio.Event()
+        super().__init__(send, **kwargs)
+
+    def _start(self, workers: int):
+        for _ in range(workers):
+            asyncio.run_coroutine_threadsafe(self._worker_async(), self.loop)
+
+    def _wakeup(self):
+        self._cond.notify_all()
+        self.loop.call_soon_threadsafe(self._event.set)
+
+    async def _next_lane_async(self) -> _Lane:
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return None
+                lane, wait = self._pop_ready_lane()
+                if lane is not None:
+                    self._sending += 1
+                    return lane
+                self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker_async(self):
+        while (lane := await self._next_lane_async()) is not None:
+            message, job = lane.queue[0]
+            await asyncio.sleep(self.global_bucket.reserve())
+            error = retry_after = None
+            try:
+                await self.send(message, lane.chat_id)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+            except Resend:
+                retry_after = 0
+            except Exception as e:
+                error = e
+            self._done(lane, job, error, retry_after)
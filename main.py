@@ -1,17 +1,35 @@
 import logging
 import jstyleson
-import importlib
+import os
+import socket
+import subprocess
+import sys
 from peewee import *
+from peewee import ModelDelete, ModelInsert, ModelUpdate
 from logging.handlers import TimedRotatingFileHandler
 from telegram import *
 from telegram.ext import Updater, Handler, CallbackContext
 from colored_log import ColoredLog
 from os.path import exists, join as path_join
-from decorators import HandlersDecorator, Auth
-from threading import Timer
+from decorators import HandlersDecorator, Auth, AuthCache
+import asyncio
+from scheduler import Scheduler, AsyncScheduler
+from delivery import DeliveryEngine, AsyncDeliveryEngine
+from runtime import AsyncRuntime
+from sender import Sender
+import outbox as outbox_module
+import media_cache as media_cache_module
+import stats as stats_module
+import shards as shards_module
+from shards import ShardCoordinator
+import models
+from models import Chatdb
+from database import create_schema, open_database, WriteBatcher
+from datetime import datetime
+import metrics
 
-from plugins.parser.model import ParserModel ,MessageModel, TextMessage, PhotoMessage, VideoMessage
-from plugins.parser.rss.plugin import Parser
+from plugins.parser.model import ParserModel, SourceModel, TextMessage
+from plugins import registry
 
 # Configure logger
 CONFIG_FILE = "config.jsonc" if exists("config.jsonc") else "config.default.jsonc"
@@ -31,12 +49,41 @@ logging.basicConfig(level=level, handlers=handlers)
 logger = logging.getLogger('Telegram-post-bot')
 DEBUG = config.get('debug',False)       #didn't used
 
+metrics_config = config.get('metrics', {})
+if metrics_config.get('enabled', False):
+    metrics.enable()
+POSTS_QUEUED = metrics.counter('posts_queued_total', 'Posts queued for delivery')
+
 # ===========================
 # Database
 # ===========================
 
 db_file = config.get('database', 'database.sqlite')
-db = SqliteDatabase(db_file)
+sqlite_config = config.get('sqlite', {})
+db = open_database(db_file,
+    cache_size=sqlite_config.get('cache-size', 64000),
+    synchronous=sqlite_config.get('synchronous', 'normal'),
+    timeout=sqlite_config.get('timeout', 30),
+)
+# writes of concurrent handlers, committed together
+writer = WriteBatcher(db, max_batch=sqlite_config.get('write-batch', 100))
+
+# authorized admins, reloaded when Admin rows change
+admins = AuthCache(lambda: Admin.select(Admin.id, Admin.privilege).tuples(), ttl=config.get('auth-cache-ttl'))
+
+class AdminWrite:
+    """Write queries of Admin, the admins cache is reloaded after they run"""
+    def _execute(self, database):
+        try:
+            return super()._execute(database)
+        finally:
+            admins.invalidate()
+
+ADMIN_WRITES = {query: type(f'Admin{query.__name__}', (AdminWrite, query), {}) for query in (ModelInsert, ModelUpdate, ModelDelete)}
+
+def admin_write(query):
+    query.__class__ = ADMIN_WRITES.get(type(query), type(query))
+    return query
 
 class Admin(Model):
     id = IntegerField(unique=True)
@@ -49,18 +96,26 @@ class Admin(Model):
     class Meta:
         database = db
 
-class Chatdb(Model):
-    id = IntegerField(unique=True)
-    type = CharField(null=True)
-    title = CharField(null=True)
-    username = CharField(null=True)
-    first_name = CharField(null=True)
-    last_name = CharField(null=True)
-    type = CharField()
-    members_count = IntegerField(default=1)
-    active = BooleanField(default=True)
-    class Meta:
-        database = db
+    # every write (save, create, delete_instance, replace, ...) is built by these, see AdminWrite
+    @classmethod
+    def insert(cls, *args, **kwargs):
+        return admin_write(super().insert(*args, **kwargs))
+
+    @classmethod
+    def insert_many(cls, *args, **kwargs):
+        return admin_write(super().insert_many(*args, **kwargs))
+
+    @classmethod
+    def insert_from(cls, *args, **kwargs):
+        return admin_write(super().insert_from(*args, **kwargs))
+
+    @classmethod
+    def update(cls, *args, **kwargs):
+        return admin_write(super().update(*args, **kwargs))
+
+    @classmethod
+    def delete(cls):
+        return admin_write(super().delete())
 
 class BotData(Model):
     interval = IntegerField(default=120)
@@ -75,17 +130,30 @@ class BotData(Model):
 cfg_parser = config['parser']
 logger.info("Loading parser (%s) plugin...", cfg_parser)
 parser_config = config['parser-config']
-parser_module = importlib.import_module('.'.join(['plugins','parser', cfg_parser, 'plugin']))
-parser_db_table = parser_module.db_table
+parser_plugins = registry.discover('parser')
+if cfg_parser not in parser_plugins:
+    logger.error("Parser plugin %s not found, available: %s", cfg_parser, ', '.join(parser_plugins) or 'none')
+    raise SystemExit(1)
+try:
+    parser_module = parser_plugins[cfg_parser].load()
+except ImportError as e:
+    logger.error("%s", e)
+    raise SystemExit(1)
+parser_db_tables = getattr(parser_module, 'db_tables', [parser_module.db_table])
 logger.info("initlizing parser database...")
 parser_module.db_proxy.initialize(db)
+outbox_module.db_proxy.initialize(db)
+media_cache_module.db_proxy.initialize(db)
+stats_module.db_proxy.initialize(db)
+models.db_proxy.initialize(db)
+shards_module.db_proxy.initialize(db)
 
 db.connect()
-for table in (Admin, Chatdb, BotData):
-    if not db.table_exists(table):
-        db.create_tables([table])
-if not db.table_exists(parser_db_table):
-    db.create_tables([parser_db_table])
+create_schema(db, [Admin, BotData] + models.db_tables + parser_db_tables + outbox_module.db_tables
+                  + media_cache_module.db_tables + stats_module.db_tables + shards_module.db_tables)
+
+statistics = stats_module.Statistics(db, Chatdb)
+statistics.ensure()
 
 def settings():
     return BotData.get_or_create()[0]
@@ -99,45 +167,149 @@ if not issubclass(type(parser),ParserModel):
     logger.error("Plugin is not a subclass of ParserModel.")
     logger.warning("A non-standard class may cause an error")
 
+# another Bot API server, e.g. a local one or the fake server of the benchmarks
+bot_api_url = config.get('bot-api-url')
+api_kwargs = dict(base_url=f'{bot_api_url}/bot', base_file_url=f'{bot_api_url}/file/bot') if bot_api_url else dict()
+delivery_config = config.get('delivery', {})
+# delivery workers share the bot's connection pool with the updater (4 workers + 4 by default)
+request_kwargs = {'con_pool_size': delivery_config.get('workers', 8) + 8}
 if 'proxy-url' in config:
     # TODO: add doc for PySocks, it is required just if user is using socks proxy
-    updater = Updater(token=config['token'], use_context=True, request_kwargs={'proxy_url': config['proxy-url']})
+    request_kwargs['proxy_url'] = config['proxy-url']
+    updater = Updater(token=config['token'], use_context=True, request_kwargs=request_kwargs, **api_kwargs)
 else:
-    updater = Updater(token=config.get('telegram-token'), use_context=True)
+    updater = Updater(token=config.get('telegram-token'), use_context=True, request_kwargs=request_kwargs, **api_kwargs)
 
 decorators = HandlersDecorator(updater.dispatcher)
 
-def admins_list():
-    return [admin.id for admin in Admin.select()]
-
-def send_message(message:MessageModel, chat_id:int):
-    if isinstance(message,TextMessage):
-        return updater.bot.send_message(chat_id=chat_id,**message.to_dict())
-    elif isinstance(message,PhotoMessage):
-        return updater.bot.send_photo(chat_id=chat_id, **message.to_dict())
-    elif isinstance(message,VideoMessage):
-        return updater.bot.send_video(chat_id=chat_id, **message.to_dict())
-    updater.bot.send_message()
-
-def send_new_posts():
-    logger.debug("Sending new posts...")
-    messages = parser.new_posts()
-    if messages:
-        logger.info("got %d messages", len(messages))
-        for chat in Chatdb.select().where(Chatdb.active == True):
-            logger.info("Sending messages to %s", chat.title)
-            for message in messages:
-                send_message(message, chat.id)
-    else:
+media_cache_config = config.get('media-cache', {})
+media_cache = media_cache_module.MediaCache(
+    max_size=media_cache_config.get('max-size', 1000),
+    ttl=media_cache_config.get('ttl', 30 * 24 * 3600),
+)
+media_cache.prune()
+
+sender = Sender(updater.bot, media_cache, proxy=config.get('proxy-url'), workers=delivery_config.get('workers', 8))
+
+# "threads" runtime uses thread pools, "async" runs polling and delivery on one asyncio event loop (requires aiohttp)
+ASYNC_RUNTIME = config.get('runtime', 'threads') == 'async'
+if ASYNC_RUNTIME:
+    runtime = AsyncRuntime()
+
+# with several delivery processes the chats are split between them by shards of their ids
+processes = delivery_config.get('processes', 1)
+coordinator = None
+shards = 1
+if processes > 1 or 'shards' in delivery_config:
+    shards = delivery_config.get('shards', 16 * processes)
+    coordinator = ShardCoordinator(db, shards, f'{socket.gethostname()}-{os.getpid()}', lease_ttl=delivery_config.get('lease-ttl', 120))
+delivery_kwargs = dict(
+    workers=delivery_config.get('workers', 8),
+    global_rate=delivery_config.get('global-rate', 30) / processes,
+    chat_rate=delivery_config.get('chat-rate', 1),
+    report_interval=delivery_config.get('report-interval', 10),
+    retries=delivery_config.get('retries', 5),
+)
+if ASYNC_RUNTIME:
+    delivery = AsyncDeliveryEngine(sender.send_async, runtime.loop, **delivery_kwargs)
+else:
+    delivery = DeliveryEngine(sender.send, **delivery_kwargs)
+outbox = outbox_module.Outbox(db, delivery, Chatdb,
+    batch_size=delivery_config.get('batch-size', 1000),
+    statistics=statistics,
+    shards=shards,
+    coordinator=coordinator,
+    poll_interval=delivery_config.get('poll-interval', 1) if coordinator else None,
+    retry_interval=delivery_config.get('retry-interval', 60),
+)
+
+stats_config = config.get('member-counts', {})
+member_counts = stats_module.MemberCountRefresher(updater.bot, db, Chatdb, statistics,
+    interval=stats_config.get('interval', 3600),
+    batch_size=stats_config.get('batch-size', 100),
+    rate=stats_config.get('rate', 5),
+    max_age=stats_config.get('max-age', 24 * 3600),
+)
+
+def send_new_posts(source:SourceModel):
+    logger.debug("Checking new posts of %s...", source.name)
+    posts = source.iter_posts()
+    count = 0
+    while True:
+        # every post is queued with the parser state of it, a crash can't lose a post between them.
+        # The next post is rendered while this one is sent. The source just reads the database until
+        # `commit`, the transaction starts with a write so it waits for other writers instead of failing.
+        messages = next(posts, None)
+        with db.atomic():
+            source.commit()
+            if messages:
+                queue_post(source, messages)
+        if messages is None:
+            break
+        if messages:
+            outbox.wake()
+            count += 1
+    if not count:
         logger.debug("No new posts")
+    return bool(count)
+
+metrics.gauge('delivery_pending_messages', 'Messages waiting in the delivery engine', lambda: delivery.pending)
+metrics.gauge('delivery_rate', 'Messages per second sent in the last report interval', lambda: delivery.rate)
+
+def queue_post(source:SourceModel, messages:list):
+    logger.info("got %d messages from %s", len(messages), source.name)
+    outbox.enqueue(messages)
+    POSTS_QUEUED.inc()
+
+def commit_post(source:SourceModel, messages:list):
+    """Commit the state of an async source and queue its post in one transaction"""
+    with db.atomic():
+        source.commit()
+        if messages:
+            queue_post(source, messages)
+    if messages:
+        outbox.wake()
+
+async def send_new_posts_async(source:SourceModel):
+    loop = asyncio.get_running_loop()
+    if not source.ASYNC:
+        # sync plugins run in the executor
+        return await loop.run_in_executor(None, send_new_posts, source)
+    count = 0
+    async for messages in source.iter_posts_async():
+        await loop.run_in_executor(None, commit_post, source, messages)
+        count += bool(messages)
+    await loop.run_in_executor(None, commit_post, source, None)
+    return bool(count)
+
+scheduler_config = config.get('scheduler', {})
+scheduler_kwargs = dict(
+    default_interval=lambda: settings().interval,
+    workers=scheduler_config.get('workers', 4),
+    jitter=scheduler_config.get('jitter', 0.1),
+    adaptive=scheduler_config.get('adaptive', False),
+    min_interval=scheduler_config.get('min-interval', 30),
+    max_interval=scheduler_config.get('max-interval', 3600),
+)
+if ASYNC_RUNTIME:
+    scheduler = AsyncScheduler(send_new_posts_async, loop=runtime.loop, **scheduler_kwargs)
+else:
+    scheduler = Scheduler(send_new_posts, **scheduler_kwargs)
+for source in parser.sources():
+    scheduler.add(source)
 
-def check_new_posts():
-    logger.debug("Checking new posts...")
-    send_new_posts()
-    logger.debug("setting timer...")
-    timer = Timer(settings().interval, check_new_posts)
-    timer.start()
-    logger.debug("timer set for %d seconds", settings().interval)
+def register_chat(chat: Chat) -> Chatdb:
+    """Add or reactivate a chat, returns its previous row. Runs in a write batch"""
+    registered = Chatdb.get_or_none(Chatdb.id == chat.id)
+    if registered is None:
+        # member count of groups is fetched in the background, a private chat is just the user
+        members_updated = datetime.now() if chat.type == Chat.PRIVATE else None
+        Chatdb.create(id=chat.id, type=chat.type, title=chat.title, username=chat.username, first_name=chat.first_name, last_name=chat.last_name, members_count=1, members_updated=members_updated)
+        statistics.chat_added(chat.type, 1)
+    elif not registered.active:
+        Chatdb.update(active=True).where(Chatdb.id == chat.id).execute()
+        statistics.chat_reactivated(registered.type, registered.members_count)
+    return registered
 
 @decorators.CommandHandler
 def start(update: Update, context: CallbackContext):
@@ -150,27 +322,69 @@ def start(update: Update, context: CallbackContext):
             update.message.reply_text("You are now a super admin.")
         #TODO: add admins registration
     
-    q = Chatdb.select().where(Chatdb.id == chat.id)
-    if q.exists():
+    registered = writer.run(register_chat, chat)
+    if registered is not None and registered.active:
         update.message.reply_text("You are already registered.")        #TODO: configurable messages
         return
-    
+
     update.message.reply_text("You are now registered.")
-    members_count = chat.get_member_count()
-    Chatdb.create(id=chat.id, type=chat.type, title=chat.title, username=chat.username, first_name=chat.first_name, last_name=chat.last_name, members_count=members_count-1)  # -1 for bot
+    if chat.type != Chat.PRIVATE:
+        member_counts.wake()
 
 @decorators.CommandHandler
-@Auth(admins_list)      # sending this method to keep this authorization up to date
+@Auth(admins)
 def members_count(update: Update, context: CallbackContext):
-    chats_count = Chatdb.select().count()
-    total_count = sum(chat.members_count for chat in Chatdb.select())
-    update.message.reply_text("There are {} chats and {} members in total.".format(chats_count, total_count))
+    totals = statistics.totals()
+    chats_count = sum(chats for (type, active), (chats, members) in totals.items() if active)
+    total_count = sum(members for (type, active), (chats, members) in totals.items() if active)
+    inactive_count = sum(chats for (type, active), (chats, members) in totals.items() if not active)
+    lines = ["There are {} chats and {} members in total.".format(chats_count, total_count)]
+    for (type, active), (chats, members) in sorted(totals.items()):
+        if active and chats:
+            lines.append("{}: {} chats, {} members".format(type, chats, members))
+    if inactive_count:
+        lines.append("{} chats are inactive.".format(inactive_count))
+    update.message.reply_text("\n".join(lines))
+
+@decorators.CommandHandler('metrics')
+@Auth(admins)
+def metrics_report(update: Update, context: CallbackContext):
+    if not metrics.registry.enabled:
+        update.message.reply_text("Metrics are disabled.")
+        return
+    # histogram buckets are too long for a message, totals are enough here
+    lines = [line for line in metrics.registry.render().splitlines() if not line.startswith('#') and '_bucket{' not in line]
+    update.message.reply_text("\n".join(lines)[:TextMessage.MAX_LENGTH] or "No metrics yet.")
 
 #TODO: remove this test message handler
 @decorators.MessageHandler()
 def echo(update: Update, context: CallbackContext):
     update.message.reply_text(update.message.text)
 
+if metrics.registry.enabled and 'port' in metrics_config:
+    metrics.serve(metrics_config.get('host', '127.0.0.1'), metrics_config['port'])
+writer.start()
 updater.start_polling()
-check_new_posts()
-updater.idle()
\ No newline at end of file
+if ASYNC_RUNTIME:
+    runtime.start()
+outbox.start()      # resumes posts left pending by a previous run
+workers = [subprocess.Popen([sys.executable, path_join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')])
+           for _ in range(processes - 1)]
+member_counts.start()
+scheduler.start()
+updater.idle()
+scheduler.stop()
+for worker in workers:
+    worker.terminate()
+outbox.stop()
+if ASYNC_RUNTIME:
+    async def close_sessions():
+        await sender.close_async()
+        await parser.close_async()
+    try:
+        runtime.submit(close_sessions()).result(10)
+    except Exception:
+        logger.exception('Closing HTTP sessions failed')
+    runtime.stop()
+for worker in workers:
+    worker.wait()
\ No newline at end of file
@@ -0,0 +1,129 @@
+# Upload-once media cache
+#
+# Telegram returns a file_id for every media it receives. Sending the same media again by its file_id
+# is much faster than by URL (Telegram doesn't download it again), so the first successful send of a
+# media URL is remembered and later sends of that URL use the file_id instead.
+# Database reads and writes happen outside the lock, a URL being loaded or uploaded is claimed meanwhile.
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Condition
+from peewee import *
+
+db_proxy = DatabaseProxy()
+
+PRUNE_INTERVAL = timedelta(days=1)     # expired rows are removed at least this often
+
+
+class MediaFile(Model):
+    url = CharField(unique=True)
+    file_id = CharField()
+    created = DateTimeField(default=datetime.now)
+    last_used = DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        database = db_proxy
+        table_name = 'media_cache'
+
+db_tables = [MediaFile]
+
+
+class MediaCache:
+    def __init__(self, max_size: int = 1000, ttl: float = 30 * 24 * 3600, wait_timeout: float = 60):
+        """
+        `max_size` limits both the in-memory LRU and the stored rows, `ttl` (seconds) is the age after which
+        a file_id is not trusted anymore.
+        """
+        self.max_size = max_size
+        self.ttl = timedelta(seconds=ttl)
+        self.wait_timeout = wait_timeout
+        self.logger = getLogger('media-cache')
+        self._lru = OrderedDict()     # url -> (file_id, created)
+        self._uploading = set()       # urls that are being loaded from database or sent by URL right now
+        self._cond = Condition()
+        self._rows = 0                # stored rows, about
+        self._pruned = datetime.now()
+
+    def lookup(self, url: str) -> str:
+        """
+        Return the file_id of `url` or None. When None is returned, the caller is responsible to upload the media
+        and call `put` or `release`. While another thread uploads the same URL, this waits for its result.
+        """
+        with self._cond:
+            while True:
+                if (file_id := self._get(url)) is not None:
+                    return file_id
+                if url not in self._uploading:
+                    self._uploading.add(url)
+                    break
+                if not self._cond.wait(self.wait_timeout):
+                    return None
+        try:
+            file_id = self._load(url)
+        except:
+            self.release(url)
+            raise
+        if file_id is not None:
+            self.release(url)
+        return file_id
+
+    def put(self, url: str, file_id: str):
+        now = datetime.now()
+        with self._cond:
+            self._remember(url, file_id, now)
+            self._uploading.discard(url)
+            self._cond.notify_all()
+        MediaFile.insert(url=url, file_id=file_id, created=now, last_used=now).on_conflict_replace().execute()
+        self._rows += 1
+        if self._rows > self.max_size or now - self._pruned > PRUNE_INTERVAL:
+            self.prune()
+
+    def release(self, url: str):
+        """Give up uploading `url` (the upload failed), another waiting thread will try it"""
+        with self._cond:
+            self._uploading.discard(url)
+            self._cond.notify_all()
+
+    def forget(self, url: str):
+        """Drop a file_id that Telegram didn't accept anymore"""
+        with self._cond:
+            self._lru.pop(url, None)
+        MediaFile.delete().where(MediaFile.url == url).execute()
+
+    def prune(self):
+        """Remove expired and least recently used rows from database"""
+        removed = MediaFile.delete().where(MediaFile.created < datetime.now() - self.ttl).execute()
+        keep = MediaFile.select(MediaFile.id).order_by(MediaFile.last_used.desc()).limit(self.max_size)
+        removed += MediaFile.delete().where(MediaFile.id.not_in(keep)).execute()
+        self._rows = MediaFile.select().count()
+        self._pruned = datetime.now()
+        if removed:
+            self.logger.debug('pruned %d cached media', removed)
+
+    def _load(self, url):
+        """Read a file_id that is not in memory from database, `url` is claimed by the caller"""
+        row = MediaFile.get_or_none(MediaFile.url == url)
+        if row is None or datetime.now() - row.created > self.ttl:
+            return None
+        MediaFile.update(last_used=datetime.now()).where(MediaFile.id == row.id).execute()
+        with self._cond:
+            self._remember(url, row.file_id, row.created)
+        return row.file_id
+
+    def _get(self, url):
+        # must be called with self._cond held
+        if (cached := self._lru.get(url)) is None:
+            return None
+        file_id, created = cached
+        if datetime.now() - created > self.ttl:
+            self._lru.pop(url, None)
+            return None
+        self._lru.move_to_end(url)
+        return file_id
+
+    def _remember(self, url, file_id, created):
+        cached = self._lru[url] = (file_id, created)
+        self._lru.move_to_end(url)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+        return cached
@@ -0,0 +1,193 @@
+# Metrics registry in the Prometheus text format
+#
+# Modules create their metrics at import time with `counter`, `histogram` and `gauge`. Until `enable` is
+# called every update returns right after one attribute check, so instrumented hot paths cost nothing
+# measurable when metrics are off.
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from threading import Lock, Thread
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_NULL_TIMER = nullcontext()
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Registry:
+    def __init__(self):
+        self.enabled = False
+        self._metrics = dict()
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = list()
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class _Metric:
+    TYPE: str = None
+
+    def __init__(self, registry: Registry, name: str, help: str, labels: tuple = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = dict()
+
+    def inc(self, amount: float = 1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_labels_text(self.label_names, key)} {value}' for key, value in values]
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, *args, buckets: tuple = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._values = dict()   # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def time(self, **labels):
+        """Context manager that observes the seconds its block took"""
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(values)) for key, values in self._values.items()]
+        lines = list()
+        for key, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                labels = _labels_text(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels_text(self.label_names, key)} {values[-1]}')
+            lines.append(f'{self.name}_count{_labels_text(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read when metrics are collected"""
+    TYPE = 'gauge'
+
+    def __init__(self, *args, function: callable, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = function
+
+    def samples(self):
+        try:
+            return [f'{self.name} {self.function()}']
+        except Exception:
+            getLogger('metrics').exception('Reading %s failed', self.name)
+            return []
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
+
+
+registry = Registry()
+
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return registry.register(Counter(registry, name, help, labels))
+
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(registry, name, help, labels, buckets=buckets))
+
+
+def gauge(name: str, help: str, function: callable) -> Gauge:
+    return registry.register(Gauge(registry, name, help, function=function))
+
+
+def enable():
+    registry.enabled = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        getLogger('metrics').debug(format, *args)
+
+
+def serve(host: str = '127.0.0.1', port: int = 9090) -> ThreadingHTTPServer:
+    """Expose the metrics on http://host:port/metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    getLogger('metrics').info('Serving metrics on http://%s:%d/metrics', host, server.server_port)
+    return server
@@ -0,0 +1,22 @@
+# Models shared by the bot and delivery worker processes
+from peewee import *
+
+db_proxy = DatabaseProxy()
+
+
+class Chatdb(Model):
+    id = IntegerField(unique=True)
+    type = CharField(null=True)
+    title = CharField(null=True)
+    username = CharField(null=True)
+    first_name = CharField(null=True)
+    last_name = CharField(null=True)
+    type = CharField()
+    members_count = IntegerField(default=1)
+    members_updated = DateTimeField(null=True, index=True)     # None until the refresher counts a group
+    active = BooleanField(default=True, index=True)
+    class Meta:
+        database = db_proxy
+        table_name = 'chatdb'
+
+db_tables = [Chatdb]
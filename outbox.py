@@ -0,0 +1,315 @@
+# Persistent delivery outbox
+#
+# Every post is stored with one outbox row per (post, chat). Rows are drained in batches through the
+# delivery engine and their status is written back in bulk, so after a crash or restart the bot
+# resumes the delivery from the chats that did not receive the post yet. Rows also count the messages
+# of the post sent so far, a chat that got part of a post gets just the rest of it.
+# Chats that can't receive messages anymore are deactivated and migrated groups get their new chat id.
+# With a shard coordinator, rows are split by chat id between delivery processes sharing the database.
+import pickle
+from datetime import datetime
+from logging import getLogger
+from threading import Event, Lock, Thread
+from peewee import *
+from telegram.error import BadRequest, ChatMigrated, InvalidToken, Unauthorized
+from delivery import is_transient_error
+from shards import ShardCoordinator, shard_of
+
+db_proxy = DatabaseProxy()
+
+PENDING, SENT, FAILED = 0, 1, 2
+
+# BadRequest descriptions of chats that are gone for good
+DEAD_CHAT_ERRORS = ('chat not found', 'chat was deactivated', 'bot was kicked', 'user is deactivated', 'peer_id_invalid')
+
+
+def is_dead_chat(error: Exception) -> bool:
+    """True if the error means no message can ever be sent to the chat (blocked, kicked, deleted)"""
+    if isinstance(error, Unauthorized):
+        # raised for 401 too, just the 403 "Forbidden: ..." answers are about the chat
+        return 'forbidden' in error.message.lower()
+    if isinstance(error, BadRequest):
+        message = error.message.lower()
+        return any(text in message for text in DEAD_CHAT_ERRORS)
+    return False
+
+
+def is_bot_failure(error: Exception) -> bool:
+    """True if the bot can't send to any chat (revoked token, a proxy answering 401)"""
+    return isinstance(error, InvalidToken) or (isinstance(error, Unauthorized) and not is_dead_chat(error))
+
+
+class Post(Model):
+    created = DateTimeField(default=datetime.now)
+    messages = BlobField()      # pickled list of MessageModel
+
+    class Meta:
+        database = db_proxy
+        table_name = 'outbox_post'
+
+
+class OutboxEntry(Model):
+    post = ForeignKeyField(Post, backref='entries', on_delete='CASCADE')
+    chat_id = IntegerField()
+    status = SmallIntegerField(default=PENDING)
+    shard = SmallIntegerField(default=0)
+    sent_messages = SmallIntegerField(default=0)    # messages of the post this chat received
+
+    class Meta:
+        database = db_proxy
+        table_name = 'outbox'
+        indexes = (
+            (('post', 'chat_id'), True),
+            (('post', 'status', 'id'), False),
+            (('post', 'shard', 'status', 'id'), False),
+        )
+
+db_tables = [Post, OutboxEntry]
+
+
+class Outbox:
+    def __init__(self, db: Database, engine, chat_model, batch_size: int = 1000, statistics=None,
+                 shards: int = 1, coordinator: ShardCoordinator = None, poll_interval: float = None,
+                 retry_interval: float = 60):
+        """
+        `chat_model` is the subscribers model, it must have `id`, `type`, `members_count` and `active` fields.
+        `statistics` (stats.Statistics) is updated when chats are deactivated.
+        With a `coordinator` just the shards leased by this process are delivered, and the outbox is
+        checked every `poll_interval` seconds for posts queued by other processes.
+        Rows that could not be sent for reasons other than the chat stay pending and are retried
+        after `retry_interval` seconds.
+        """
+        self.db = db
+        self.engine = engine
+        self.chat_model = chat_model
+        self.batch_size = batch_size
+        self.statistics = statistics
+        self.shards = shards
+        self.coordinator = coordinator
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.logger = getLogger('outbox')
+        self._results = list()      # (entry id, status) waiting to be written
+        self._progress = dict()     # entry id -> messages sent, waiting to be written
+        self._dead = set()          # chat ids to deactivate
+        self._migrated = dict()     # entry id -> (old chat id, new chat id)
+        self._saved = 0             # sends skipped because of deactivated chats since the last post log
+        self._halted = None         # error that stopped the delivery, see is_bot_failure
+        self._retry = False         # rows were left pending by the last drain
+        self._results_lock = Lock()
+        self._wake = Event()
+
+    def start(self):
+        """Drain the outbox in a background thread, once now (to resume) and whenever `wake` is called"""
+        self._wake.set()
+        if self.coordinator is not None:
+            self.coordinator.start()
+        Thread(target=self._run, name='outbox', daemon=True).start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        """Write down the sends in progress, the rows of unsent messages stay pending for the next start"""
+        self.engine.stop()
+        self.flush()
+        if self.coordinator is not None:
+            self.coordinator.release()
+
+    def _run(self):
+        while True:
+            timeout = self.poll_interval
+            if self.coordinator is not None:
+                # leases are renewed by the drainer, an idle one wakes up for them too
+                timeout = min(timeout or self.coordinator.lease_ttl / 4, self.coordinator.lease_ttl / 4)
+            if self._retry:
+                timeout = min(timeout or self.retry_interval, self.retry_interval)
+            if self._halted is not None:
+                self.logger.error('Delivery stopped, the bot can not send messages: %s. Retrying in %d seconds',
+                                  self._halted, self.retry_interval)
+                timeout = self.retry_interval
+            self._wake.wait(timeout)
+            self._wake.clear()
+            self._halted = None
+            self._retry = False
+            try:
+                self.drain()
+            except Exception:
+                self.logger.exception('Draining outbox failed')
+
+    def enqueue(self, messages: list) -> Post:
+        """
+        Store the messages and create an outbox row for every active chat. Call it inside the same
+        transaction that updates the parser state, so a post is never marked as seen without being queued.
+        """
+        Chat = self.chat_model
+        with self.db.atomic():
+            post = Post.create(messages=pickle.dumps(messages, pickle.HIGHEST_PROTOCOL))
+            chats = Chat.select(Value(post.id), Chat.id, Value(PENDING), shard_of(Chat.id, self.shards), Value(0)).where(Chat.active == True)
+            count = OutboxEntry.insert_from(chats, [OutboxEntry.post, OutboxEntry.chat_id, OutboxEntry.status, OutboxEntry.shard,
+                                                    OutboxEntry.sent_messages]).as_rowcount().execute()
+        if self.statistics is not None:
+            inactive = sum(chats for (type, active), (chats, members) in self.statistics.totals().items() if not active)
+            self.logger.info('Post %d queued for %d chats, %d inactive chats skipped', post.id, count, inactive)
+        else:
+            self.logger.info('Post %d queued for %d chats', post.id, count)
+        return post
+
+    def drain(self):
+        """Deliver every pending outbox row (of the leased shards), oldest post first"""
+        if self.coordinator is not None:
+            self.coordinator.heartbeat()
+        last_id = 0
+        # posts queued while draining are picked up too
+        while (post := Post.select().where(Post.id > last_id).order_by(Post.id).first()) is not None:
+            last_id = post.id
+            self._drain_post(post)
+            if self._halted is not None:
+                break
+
+    def _drain_post(self, post: Post):
+        messages = pickle.loads(post.messages)
+        if self.coordinator is None:
+            sent_before = OutboxEntry.select().where((OutboxEntry.post == post) & (OutboxEntry.status != PENDING)).count()
+            if sent_before:
+                self.logger.info('Resuming post %d, %d chats are already done', post.id, sent_before)
+
+        batch_size = self.batch_size
+        if self.coordinator is not None:
+            # shards are given back between batches, a batch takes at most a quarter of the lease to send
+            sendable = self.engine.global_bucket.rate * self.coordinator.lease_ttl / 4
+            batch_size = max(1, min(batch_size, int(sendable / len(messages))))
+        last_id = 0
+        requeued = 0
+        self._saved = 0
+        while True:
+            if self.coordinator is not None and self.coordinator.due():
+                # shards may be given back, nothing of them may be in flight
+                self.engine.join()
+                requeued += self.flush()
+                self.coordinator.heartbeat()
+            condition = (OutboxEntry.post == post) & (OutboxEntry.status == PENDING) & (OutboxEntry.id > last_id)
+            if self.coordinator is not None:
+                condition &= OutboxEntry.shard.in_(self.coordinator.owned)
+            batch = list() if self._halted is not None else list(OutboxEntry
+                .select(OutboxEntry.id, OutboxEntry.chat_id, OutboxEntry.sent_messages)
+                .where(condition)
+                .order_by(OutboxEntry.id)
+                .limit(batch_size)
+                .tuples())
+            if not batch:
+                self.engine.join()
+                # rows of migrated chats are pending again with the new chat id, start over for them
+                requeued += self.flush()
+                if not requeued or self._halted is not None:
+                    break
+                last_id = requeued = 0
+                continue
+            last_id = batch[-1][0]
+            for entry_id, chat_id, sent in batch:
+                # a single message post is done or not, just longer ones count the progress
+                progress = self._progress_callback(entry_id, sent) if len(messages) > 1 else None
+                self.engine.submit(chat_id, messages[sent:], self._callback(entry_id), progress)
+            # keep about one batch in flight, then write down what was delivered meanwhile
+            self.engine.join(max_pending=batch_size * len(messages))
+            requeued += self.flush()
+
+        pending = OutboxEntry.select().where((OutboxEntry.post == post) & (OutboxEntry.status == PENDING))
+        if self._halted is not None or pending.exists():
+            if self.coordinator is not None and self._halted is None:
+                self.logger.debug('Post %d is done in the shards of this worker', post.id)
+            else:
+                self._retry = True
+                self.logger.warning('Post %d: %d chats left pending, retrying later', post.id, pending.count())
+            return
+        with self.db.atomic('IMMEDIATE'):     # reads first, a deferred transaction could not upgrade its lock
+            stats = dict(OutboxEntry.select(OutboxEntry.status, fn.COUNT(OutboxEntry.id))
+                .where(OutboxEntry.post == post)
+                .group_by(OutboxEntry.status)
+                .tuples())
+            OutboxEntry.delete().where(OutboxEntry.post == post).execute()
+            post.delete_instance()
+        self.logger.info('Post %d delivered to %d chats, %d failed', post.id, stats.get(SENT, 0), stats.get(FAILED, 0))
+        if self._saved:
+            self.logger.info('%d queued sends to deactivated chats skipped', self._saved)
+
+    def _callback(self, entry_id: int):
+        def callback(chat_id, error):
+            if is_bot_failure(error):
+                # the row stays pending, no chat is to blame
+                self._halted = error
+                return
+            if is_transient_error(error):
+                return      # retried by the next drain
+            with self._results_lock:
+                self._results.append((entry_id, SENT if error is None else FAILED))
+                if isinstance(error, ChatMigrated):
+                    self._migrated[entry_id] = (chat_id, error.new_chat_id)
+                elif is_dead_chat(error):
+                    self._dead.add(chat_id)
+        return callback
+
+    def _progress_callback(self, entry_id: int, sent_before: int):
+        def progress(chat_id, sent):
+            with self._results_lock:
+                self._progress[entry_id] = sent_before + sent
+        return progress
+
+    def flush(self) -> int:
+        """Write delivery results in one transaction, returns the number of rows queued again for migrated chats"""
+        with self._results_lock:
+            results, self._results = self._results, list()
+            progress, self._progress = self._progress, dict()
+            dead, self._dead = self._dead, set()
+            migrated, self._migrated = self._migrated, dict()
+        by_status = dict()
+        for entry_id, status in results:
+            by_status.setdefault(status, list()).append(entry_id)
+            if entry_id not in migrated:
+                progress.pop(entry_id, None)    # finished rows don't need it, migrated ones are sent again
+        if not results and not progress:
+            return 0
+        by_progress = dict()
+        for entry_id, sent in progress.items():
+            by_progress.setdefault(sent, list()).append(entry_id)
+        with self.db.atomic():
+            for status, ids in by_status.items():
+                for chunk in chunked(ids, 500):     # stay below SQLite variables limit
+                    OutboxEntry.update(status=status).where(OutboxEntry.id.in_(chunk)).execute()
+            for sent, ids in by_progress.items():
+                for chunk in chunked(ids, 500):
+                    OutboxEntry.update(sent_messages=sent).where(OutboxEntry.id.in_(chunk)).execute()
+            requeued = 0
+            for entry_id, (old_id, new_id) in migrated.items():
+                if self._migrate(entry_id, old_id, new_id):
+                    requeued += 1
+                else:
+                    dead.add(old_id)
+            if dead:
+                self._deactivate(dead)
+        return requeued
+
+    def _migrate(self, entry_id: int, old_id: int, new_id: int) -> bool:
+        """Move a group that became a supergroup to its new chat id, False if the new chat is registered already"""
+        Chat = self.chat_model
+        if Chat.select().where(Chat.id == new_id).exists():
+            return False
+        Chat.update(id=new_id).where(Chat.id == old_id).execute()
+        OutboxEntry.update(chat_id=new_id, status=PENDING, shard=shard_of(new_id, self.shards)).where(
+            (OutboxEntry.chat_id == old_id) & ((OutboxEntry.status == PENDING) | (OutboxEntry.id == entry_id))).execute()
+        self.logger.info('Chat %d migrated to %d', old_id, new_id)
+        return True
+
+    def _deactivate(self, chat_ids: set):
+        """Mark chats inactive and drop their pending rows of other posts"""
+        Chat = self.chat_model
+        chats = list()
+        for chunk in chunked(list(chat_ids), 500):
+            condition = Chat.id.in_(chunk) & (Chat.active == True)
+            chats.extend(Chat.select(Chat.type, Chat.members_count).where(condition).tuples())
+            Chat.update(active=False).where(condition).execute()
+            self._saved += OutboxEntry.update(status=FAILED).where(
+                OutboxEntry.chat_id.in_(chunk) & (OutboxEntry.status == PENDING)).execute()
+        if self.statistics is not None:
+            self.statistics.chats_deactivated(chats)
+        self.logger.info('%d chats deactivated', len(chats))
@@ -0,0 +1,131 @@
+# Media checks before sending media by URL
+#
+# Telegram downloads media sent by URL itself and refuses files over its limits, so media of a post are
+# checked with HEAD requests first. Requests of a post run concurrently with a timeout and results are
+# cached, so a slow host costs one timeout per TTL instead of stalling every poll.
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from logging import getLogger
+from threading import Lock
+from time import monotonic
+import requests
+from runtime import import_aiohttp
+
+# sizes Telegram downloads when media are sent by URL
+SIZE_LIMITS = {
+    'img': 5 * 1024 * 1024,
+    'video': 20 * 1024 * 1024,
+}
+
+
+@dataclass(frozen=True)
+class ProbeResult:
+    reachable: bool
+    content_type: str = None
+    size: int = None            # None if the server didn't send Content-Length
+    attachment: bool = False    # Content-Disposition is attachment
+
+    def fits(self, kind: str) -> bool:
+        """False if the media is known to be larger than Telegram downloads"""
+        return self.size is None or self.size <= SIZE_LIMITS.get(kind, SIZE_LIMITS['video'])
+
+    def downloadable(self, kind: str) -> bool:
+        """True if Telegram can download this media by its URL"""
+        if not self.reachable or not self.fits(kind):
+            return False
+        if kind == 'video':
+            return self.attachment or (self.content_type or '').startswith('video/')
+        return True
+
+UNREACHABLE = ProbeResult(False)
+
+
+class MediaProbe:
+    def __init__(self, session: requests.Session, timeout: float = 10, ttl: float = 3600, failure_ttl: float = 300,
+                 max_size: int = 10000, workers: int = 8):
+        """
+        `ttl` is how many seconds results are cached, `failure_ttl` is used for failed requests.
+        """
+        self.session = session
+        self.timeout = timeout
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_size = max_size
+        self.logger = getLogger('media-probe')
+        self._cache = OrderedDict()     # url -> (expires, ProbeResult)
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='probe')
+
+    def cached(self, url: str) -> ProbeResult:
+        with self._lock:
+            item = self._cache.get(url)
+            if item is None:
+                return None
+            if item[0] < monotonic():
+                del self._cache[url]
+                return None
+            self._cache.move_to_end(url)
+            return item[1]
+
+    def _store(self, url: str, result: ProbeResult) -> ProbeResult:
+        ttl = self.ttl if result.reachable else self.failure_ttl
+        with self._lock:
+            self._cache[url] = (monotonic() + ttl, result)
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _result(status: int, headers) -> ProbeResult:
+        if status in (405, 501):
+            return ProbeResult(True)    # HEAD is not supported, nothing is known
+        if status >= 400:
+            return UNREACHABLE
+        length = headers.get('Content-Length')
+        return ProbeResult(
+            reachable=True,
+            content_type=headers.get('Content-Type', '').split(';')[0].strip().lower() or None,
+            size=int(length) if length and length.isdigit() else None,
+            attachment='attachment' in headers.get('Content-Disposition', ''),
+        )
+
+    def probe(self, url: str) -> ProbeResult:
+        if (result := self.cached(url)) is not None:
+            return result
+        try:
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            result = self._result(response.status_code, response.headers)
+        except requests.RequestException as e:
+            self.logger.warning('checking media %s failed: %s', url, e)
+            result = UNREACHABLE
+        return self._store(url, result)
+
+    def probe_many(self, urls) -> dict:
+        """Check URLs concurrently, returns a {url: ProbeResult} dict"""
+        urls = list(dict.fromkeys(urls))
+        missing = [url for url in urls if self.cached(url) is None]
+        if len(missing) > 1:
+            list(self._pool.map(self.probe, missing))
+        return {url: self.probe(url) for url in urls}
+
+    async def probe_many_async(self, urls, session) -> dict:
+        """Async variant of `probe_many` with an aiohttp session"""
+        urls = list(dict.fromkeys(urls))
+        # the session of the feeds has the feed timeout, checks have their own
+        timeout = import_aiohttp().ClientTimeout(total=self.timeout)
+
+        async def probe(url):
+            if (result := self.cached(url)) is not None:
+                return result
+            try:
+                async with session.head(url, allow_redirects=True, timeout=timeout) as response:
+                    result = self._result(response.status, response.headers)
+            except Exception as e:      # aiohttp errors, timeouts
+                self.logger.warning('checking media %s failed: %r', url, e)
+                result = UNREACHABLE
+            return self._store(url, result)
+
+        return dict(zip(urls, await asyncio.gather(*map(probe, urls))))
@@ -1,19 +1,69 @@
 # Parsers plugin abstract class
 
+import json
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Iterable
+from typing import AsyncIterator, Iterable, Iterator
 from abc import ABC, abstractmethod, abstractproperty
-from telegram import InlineKeyboardButton, ParseMode, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, ParseMode, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
 
 
 
+def keyboard_markup_dict(inline_keyboard) -> dict:
+    """Bot API reply_markup of an inline keyboard, buttons may be dicts or InlineKeyboardButton"""
+    if not inline_keyboard:
+        return None
+    return {'inline_keyboard': [[button if isinstance(button, dict) else button.to_dict() for button in row] for row in inline_keyboard]}
+
+class Payload:
+    """A pre-serialised Bot API request, only `chat_id` is added for each send"""
+    __slots__ = ('method', 'body')
+
+    def __init__(self, method: str, data: dict):
+        self.method = method
+        self.body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+    def for_chat(self, chat_id: int) -> bytes:
+        return b'{"chat_id":%d,%b' % (chat_id, self.body[1:])
+
 class MessageModel(ABC):
-    pass
+    METHOD: str = None          # Bot API method that sends this message
+    MEDIA_KEY: str = None       # request field of the media, just for media messages
+
+    @abstractmethod
+    def to_dict(self) -> dict:
+        pass
+
+    def to_api_dict(self) -> dict:
+        """Bot API request fields except chat_id, None fields are omitted"""
+        data = self.to_dict()
+        data['reply_markup'] = keyboard_markup_dict(self.inline_keyboard)
+        return {k: v for k, v in data.items() if v is not None}
+
+    def payload(self, media: str = None) -> Payload:
+        """
+        The request of this message, serialised once and reused for every chat. `media` replaces
+        the media URL (e.g. with a cached file_id). The message must not be changed after this is called.
+        """
+        payloads = self.__dict__.setdefault('_payloads', dict())
+        if (payload := payloads.get(media)) is None:
+            data = self.to_api_dict()
+            if media is not None:
+                self._replace_media(data, media)
+            payload = payloads[media] = Payload(self.METHOD, data)
+        return payload
+
+    def _replace_media(self, data: dict, media):
+        data[self.MEDIA_KEY] = media
+
+    def file_id(self, result: dict) -> str:
+        """file_id of the media in the Bot API result of sending this message"""
+        raise NotImplementedError()
 
 @dataclass
 class TextMessage(MessageModel):
     MAX_LENGTH = 4096
+    METHOD = 'sendMessage'
     text: str
     parse_mode: str = ParseMode.MARKDOWN
     inline_keyboard: Iterable[Iterable[dict]] | Iterable[Iterable[InlineKeyboardButton]] = None
@@ -24,7 +74,7 @@ class TextMessage(MessageModel):
         return {
             'text': self.text,
             'parse_mode': self.parse_mode,
-            'reply_markup': InlineKeyboardMarkup(self.inline_keyboard),
+            'reply_markup': InlineKeyboardMarkup(self.inline_keyboard) if self.inline_keyboard else None,
             'disable_web_page_preview': self.disable_web_page_preview,
             'disable_notification': self.disable_notification,
         }
@@ -32,6 +82,8 @@ class TextMessage(MessageModel):
 @dataclass
 class PhotoMessage(MessageModel):
     MAX_LENGTH = 200
+    METHOD = 'sendPhoto'
+    MEDIA_KEY = 'photo'
     photo: str
     text: str = None
     parse_mode: str = ParseMode.MARKDOWN
@@ -43,12 +95,18 @@ class PhotoMessage(MessageModel):
             'photo': self.photo,
             'caption': self.text,
             'parse_mode': self.parse_mode,
-            'reply_markup': InlineKeyboardMarkup(self.inline_keyboard),
+            'reply_markup': InlineKeyboardMarkup(self.inline_keyboard) if self.inline_keyboard else None,
             'disable_notification': self.disable_notification,
         }
 
+    def file_id(self, result: dict) -> str:
+        return result['photo'][-1]['file_id']
+
+@dataclass
 class VideoMessage(MessageModel):
     MAX_LENGTH = 200
+    METHOD = 'sendVideo'
+    MEDIA_KEY = 'video'
     video: str
     text: str = None
     parse_mode: str = ParseMode.MARKDOWN
@@ -60,15 +118,135 @@ class VideoMessage(MessageModel):
             'video': self.video,
             'caption': self.text,
             'parse_mode': self.parse_mode,
-            'reply_markup': InlineKeyboardMarkup(self.inline_keyboard),
+            'reply_markup': InlineKeyboardMarkup(self.inline_keyboard) if self.inline_keyboard else None,
             'disable_notification': self.disable_notification,
         }
 
-class ParserModel(ABC):
+    def file_id(self, result: dict) -> str:
+        return result['video']['file_id']
+
+@dataclass
+class MediaGroupMessage(MessageModel):
+    """An album of photos and videos sent with a single sendMediaGroup request"""
+    MAX_ITEMS = 10
+    METHOD = 'sendMediaGroup'
+    media: list             # PhotoMessage | VideoMessage items, caption of the first one is the album caption
+    disable_notification: bool = False
+    inline_keyboard = None  # albums can't have an inline keyboard
+
+    def to_dict(self):
+        media = list()
+        for item in self.media:
+            InputMedia = InputMediaPhoto if isinstance(item, PhotoMessage) else InputMediaVideo
+            media.append(InputMedia(getattr(item, item.MEDIA_KEY), caption=item.text, parse_mode=item.parse_mode))
+        return {
+            'media': media,
+            'disable_notification': self.disable_notification,
+        }
+
+    def to_api_dict(self):
+        media = list()
+        for item in self.media:
+            input_media = {'type': item.MEDIA_KEY, 'media': getattr(item, item.MEDIA_KEY)}
+            if item.text is not None:
+                input_media['caption'] = item.text
+                input_media['parse_mode'] = item.parse_mode
+            media.append(input_media)
+        return {
+            'media': media,
+            'disable_notification': self.disable_notification,
+        }
+
+    def _replace_media(self, data: dict, media: tuple):
+        # media is a tuple with a file_id or URL for every item
+        for input_media, file in zip(data['media'], media):
+            input_media['media'] = file
+
+    def file_ids(self, result: list) -> list:
+        """file_ids of all items in the Bot API result of sending this album"""
+        return [item.file_id(message) for item, message in zip(self.media, result)]
+
+def group_media(messages: list) -> list:
+    """
+    Collapse runs of consecutive photos and videos into albums of up to `MediaGroupMessage.MAX_ITEMS`.
+    Media with an inline keyboard are kept separate. A caption is allowed on the last item of a run (the
+    text that follows the media), it is moved to the first item to become the album caption.
+    """
+    result = list()
+    run = list()
+
+    def close_run():
+        for i in range(0, len(run), MediaGroupMessage.MAX_ITEMS):
+            items = run[i:i + MediaGroupMessage.MAX_ITEMS]
+            if len(items) == 1:
+                result.append(items[0])
+                continue
+            if items[-1].text is not None and items[0].text is None:
+                items[0].text, items[0].parse_mode, items[-1].text = items[-1].text, items[-1].parse_mode, None
+            result.append(MediaGroupMessage(items, disable_notification=items[0].disable_notification))
+        run.clear()
+
+    for message in messages:
+        if isinstance(message, (PhotoMessage, VideoMessage)) and not message.inline_keyboard:
+            run.append(message)
+            if message.text is not None:
+                close_run()
+        else:
+            close_run()
+            result.append(message)
+    close_run()
+    return result
+
+class SourceModel(ABC):
+    """A source of posts that is polled by the bot core on its own schedule"""
+    name: str = None
+    interval: float = None      # seconds between polls, None to use the bot interval
+
+    ASYNC = False               # True if new_posts_async or iter_posts_async is implemented
+
+    @abstractmethod
+    def new_posts(self) -> Iterable[MessageModel]:
+        pass
+
+    def iter_posts(self) -> Iterator[list[MessageModel]]:
+        """
+        Yields new posts one by one as soon as each is ready, a post is a list of messages. The bot queues
+        every post in its own transaction and calls `commit` in it, so sending starts with the first post.
+        By default all messages of `new_posts` are a single post.
+        """
+        messages = self.new_posts()
+        if messages:
+            yield list(messages)
+
+    async def iter_posts_async(self) -> AsyncIterator[list[MessageModel]]:
+        """Async variant of `iter_posts` used by the async runtime, by default it wraps `new_posts_async`"""
+        messages = await self.new_posts_async()
+        if messages:
+            yield list(messages)
+
+    async def new_posts_async(self) -> Iterable[MessageModel]:
+        """
+        Async variant of `new_posts` used by the async runtime. State changes are kept in memory until
+        `commit` is called, so they are written in the same transaction that queues the posts.
+        Sources with ASYNC = False don't need it, the runtime runs their `new_posts` in an executor.
+        """
+        raise NotImplementedError()
+
+    def commit(self):
+        """Write the state changed by the last `new_posts_async` call, or by the posts yielded so far"""
+        pass
+
+class ParserModel(SourceModel):
 
     @abstractmethod
     def __init__(self, config):
         self.config = config
+        self.name = type(self).__module__
+        self.interval = None
+
+    def sources(self) -> Iterable[SourceModel]:
+        """Sources that bot core polls separately. By default the whole parser is a single source"""
+        return [self]
 
     @abstractmethod
     def new_posts(self) -> Iterable[MessageModel]:
@@ -78,4 +256,8 @@ class ParserModel(ABC):
     @abstractmethod
     def last_post(self) -> Iterable[MessageModel]:
         """The method that will be call when user sends `/last` command"""
+        pass
+
+    async def close_async(self):
+        """Release resources of the async runtime (e.g. HTTP sessions), called on its event loop at exit"""
         pass
\ No newline at end of file
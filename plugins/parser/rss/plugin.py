@@ -2,73 +2,330 @@
 from peewee import *
 from plugins.parser.model import *
 from logging import getLogger
-import feedparser, requests
-from urllib.parse import urlparse
-from bs4 import BeautifulSoup as Soup
+from hashlib import sha1
+from html import escape
+from requests.adapters import HTTPAdapter
+import asyncio, requests
+import metrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from plugins.parser.rss.sanitizer import Media, sanitize
+from plugins.parser.media_probe import MediaProbe
+from runtime import import_aiohttp
+from plugins.parser.telegram_html import truncate_html
 from telegram import ParseMode
 from time import mktime, sleep,struct_time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 def convert_date(struct:struct_time):
         return datetime.fromtimestamp(mktime(struct))
 
+FETCH_SECONDS = metrics.histogram('rss_fetch_seconds', 'Feed download latency')
+FETCHES = metrics.counter('rss_fetches_total', 'Feed downloads by HTTP status', labels=('status',))
+ENTRIES = metrics.counter('rss_new_entries_total', 'New feed entries found by polls')
+RENDER_SECONDS = metrics.histogram('rss_render_seconds', 'Time spent rendering posts by stage', labels=('stage',))
+
 db_proxy = DatabaseProxy()
 class RSS_reader_Data(Model):
     last_post_date = DateTimeField(null=True)
     source = CharField(null=True) # this will use to check if source changed or not
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    content_hash = CharField(null=True) # sha1 of the last parsed feed body
 
     class Meta:
         database = db_proxy
         db_table = 'rss_reader_data'
 
+class RSS_reader_Entry(Model):
+    """Entries already seen in a feed, the poll sends just entries that are not here"""
+    feed = ForeignKeyField(RSS_reader_Data, on_delete='CASCADE')
+    key = BigIntegerField()             # hash of the entry id (GUID), or its link
+    content_hash = BigIntegerField()    # hash of the title and content, to notice edited entries
+    seen = DateTimeField()              # last poll that found the entry in the feed
+
+    class Meta:
+        database = db_proxy
+        table_name = 'rss_reader_entry'
+        indexes = (
+            (('feed', 'key'), True),
+            (('feed', 'seen'), False),
+        )
+
 db_table = RSS_reader_Data
-class Parser(ParserModel):
-    def __init__(self, config):
-        super().__init__(config)
+db_tables = [RSS_reader_Data, RSS_reader_Entry]
+
+def short_hash(*values) -> int:
+    """64 bit signed hash that fits in a SQLite integer"""
+    digest = sha1('\0'.join(v or '' for v in values).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def entry_key(entry) -> int:
+    return short_hash(entry.get('id') or entry.get('link') or entry.get('title'))
+
+def entry_content_hash(entry) -> int:
+    contents = [c.get('value') for c in entry.get('content', [])]
+    return short_hash(entry.get('title'), entry.get('summary'), *contents)
+
+class Feed(SourceModel):
+    """A single RSS source with its own state row and polling interval"""
+    ASYNC = True
+
+    def __init__(self, parser, config:dict, properties:RSS_reader_Data, created:bool = False):
+        self.parser = parser
+        self.config = config
+        self.name = config['source']
+        self.interval = config.get('interval')
         self.logger = getLogger('RSS-reader')
-        self.logger.info('Initializing RSS reader plugin...')
-        self.properties = RSS_reader_Data.get_or_create(source=self.config['source'])[0]
-        if self.config.get('check-host',True):
-            self.logger.debug(f"checking hostname change. properties:{urlparse(self.properties.source).hostname} == config:{urlparse(self.config['source']).hostname}")
-            if urlparse(self.properties.source).hostname != urlparse(self.config['source']).hostname:
-                self.logger.info('Source changed, updating...')
-                self.logger.warning('When source changes or bot runs for the first time it just saves the last post date and does not send any post to subscribers.')
-                self.properties.source = self.config['source']
-                self.properties.last_post_date = None
-                self.properties.save()
-        else:
-            self.logger.debug('check-host skipped')
+        self.properties = properties
+        if created:
+            self.logger.warning('%s is a new source. At first poll the bot just saves the current entries and does not send any post to subscribers.', self.name)
+        self._seen = list()     # entry index rows of the last poll, written by `commit`
+        self._finished = False  # the feed state is saved when all new posts are queued
 
-    def new_posts(self):
-        self.logger.info("Getting new posts...")
-        req = requests.get(self.properties.source)
-        feeds = feedparser.parse(req.content)
-        if req.status_code != 200:
-            self.logger.error("Error: %d", req.status_code)
+    def _conditional_headers(self):
+        headers = dict()
+        if self.properties.etag:
+            headers['If-None-Match'] = self.properties.etag
+        if self.properties.last_modified:
+            headers['If-Modified-Since'] = self.properties.last_modified
+        return headers
+
+    def _check_response(self, status:int, headers, content:bytes):
+        """Update the conditional GET state, returns the content if it should be parsed"""
+        FETCHES.inc(status=status)
+        if status == 304:
+            self.logger.debug("%s: feed not modified", self.name)
             return
-        if feeds.bozo == 1:
-            self.logger.error("Error: %s", feeds.bozo_exception)
+        if status != 200:
+            self.logger.error("%s: error %d", self.name, status)
             return
-        if not feeds.entries:
-            self.logger.error("Error: No entry found")
+        self.properties.etag = headers.get('ETag')
+        self.properties.last_modified = headers.get('Last-Modified')
+        content_hash = sha1(content).hexdigest()
+        if content_hash == self.properties.content_hash:
+            # some servers don't support conditional requests
+            self.logger.debug("%s: feed content not changed", self.name)
             return
-        check_date = self.config.get('check-date',True)     # This config is useful for debug
+        self.properties.content_hash = content_hash
+        return content
+
+    def fetch(self):
+        """
+        Download the feed with a conditional GET, returns None if the feed is not changed since last poll
+        """
+        try:
+            with FETCH_SECONDS.time():
+                req = self.parser.session.get(self.properties.source, headers=self._conditional_headers(), timeout=self.parser.timeout)
+        except requests.RequestException:
+            FETCHES.inc(status='error')
+            raise
+        return self._check_response(req.status_code, req.headers, req.content)
+
+    async def fetch_async(self):
+        session = self.parser.async_session()
+        try:
+            with FETCH_SECONDS.time():
+                async with session.get(self.properties.source, headers=self._conditional_headers()) as response:
+                    content = await response.read()
+        except Exception:
+            FETCHES.inc(status='error')
+            raise
+        return self._check_response(response.status, response.headers, content)
+
+    def new_posts(self):
+        messages = [message for post in self.iter_posts() for message in post]
+        self.commit()
+        return messages
+
+    def iter_posts(self):
+        self.logger.info("Getting new posts from %s...", self.name)
+        self._finished = False
+        rendering = deque()     # (entry, future) in feed order
+        try:
+            if (content := self.fetch()) is not None:
+                template = self.config.get('post-template')
+                # entries are rendered by the pool up to `render-ahead` posts before they are queued
+                for entry in self._new_entries(content):
+                    rendering.append((entry, self.parser.render_pool.submit(self.parser.render_post, entry, template)))
+                    if len(rendering) >= self.parser.render_ahead:
+                        entry, future = rendering.popleft()
+                        yield self._rendered(entry, future.result())
+                while rendering:
+                    entry, future = rendering.popleft()
+                    yield self._rendered(entry, future.result())
+        except:
+            for entry, future in rendering:
+                future.cancel()
+            self._rollback()
+            raise
+        self._finished = True
+
+    async def iter_posts_async(self):
+        self.logger.info("Getting new posts from %s...", self.name)
+        loop = asyncio.get_running_loop()
+        self._finished = False
+        rendering = deque()     # (entry, task) in feed order
+        try:
+            if (content := await self.fetch_async()) is not None:
+                # parsing and rendering are CPU bound, they run in the executor; just media checks are awaited here
+                entries = await loop.run_in_executor(None, self._new_entries, content)
+                for entry in entries:
+                    rendering.append((entry, asyncio.ensure_future(self._render_async(entry))))
+                    if len(rendering) >= self.parser.render_ahead:
+                        entry, task = rendering.popleft()
+                        yield self._rendered(entry, await task)
+                while rendering:
+                    entry, task = rendering.popleft()
+                    yield self._rendered(entry, await task)
+        except:
+            for entry, task in rendering:
+                task.cancel()
+            self._rollback()
+            raise
+        self._finished = True
+
+    async def _render_async(self, entry):
+        loop = asyncio.get_running_loop()
+        # sanitizing is CPU bound like rendering, just the media checks run on the loop
+        fragments = await loop.run_in_executor(None, self.parser.prepare_post, entry, self.config.get('post-template'))
+        probes = await self.parser.probe_media_async(fragments)
+        return await loop.run_in_executor(None, self.parser.render_fragments, fragments, entry.link, probes)
 
-        if self.properties.last_post_date is None and check_date:
-            self.properties.last_post_date = convert_date(max([e.published_parsed for e in feeds.entries]))
+    def _rendered(self, entry, messages):
+        """Mark a new entry as seen when its post is committed, returns its messages"""
+        if (row := self._pending_entries.pop(id(entry))) is not None:
+            self._seen.append(row)
+        return messages
+
+    def commit(self):
+        # the feed state is written after the last post, so an interrupted poll parses the feed again
+        # and the index skips the posts that were queued already
+        if self._finished:
             self.properties.save()
-            if check_date:
-                # at default it will return here, but not when check-date is False
-                return
-        messages = list()
+        if not self._seen:
+            return
+        seen, self._seen = self._seen, list()
+        for chunk in chunked(seen, 200):       # stay below SQLite variables limit
+            RSS_reader_Entry.insert_many(chunk).on_conflict(
+                conflict_target=[RSS_reader_Entry.feed, RSS_reader_Entry.key],
+                preserve=[RSS_reader_Entry.content_hash, RSS_reader_Entry.seen],
+            ).execute()
+        # forget entries that left the feed long ago, feeds don't bring back such old entries
+        retention = timedelta(days=self.config.get('seen-retention', 30))
+        RSS_reader_Entry.delete().where((RSS_reader_Entry.feed == self.properties) & (RSS_reader_Entry.seen < seen[0]['seen'] - retention)).execute()
+
+    def _rollback(self):
+        # don't keep the new content hash in memory, the feed should be parsed again next time
+        self.properties = RSS_reader_Data.get_by_id(self.properties.id)
+        self._seen = list()
+        self._finished = False
+
+    def _new_entries(self, content:bytes):
+        import feedparser      # imported by the first poll, not at startup
+        feeds = feedparser.parse(content)
+        if feeds.bozo == 1:
+            self.logger.error("%s: error %s", self.name, feeds.bozo_exception)
+            return []
+        if not feeds.entries:
+            self.logger.error("%s: no entry found", self.name)
+            return []
+        if not self.config.get('check-date',True):
+            # This config is useful for debug, always send all posts
+            self._pending_entries = {id(entry): None for entry in feeds.entries}
+            return feeds.entries
+
+        now = datetime.now()
+        current = dict()    # key -> (entry, content hash), feed order
         for entry in feeds.entries:
-            if check_date:
-                # if check-date is False Always send all posts
-                if entry.published_parsed <= self.properties.last_post_date:
-                    continue
-                self.properties.last_post_date = entry.published_parsed
-                self.properties.save()
-            messages.extend(self.render_post(entry))
+            current.setdefault(entry_key(entry), (entry, entry_content_hash(entry)))
+        known = dict()
+        for chunk in chunked(list(current), 500):
+            known.update(RSS_reader_Entry
+                .select(RSS_reader_Entry.key, RSS_reader_Entry.content_hash)
+                .where((RSS_reader_Entry.feed == self.properties) & RSS_reader_Entry.key.in_(chunk))
+                .tuples())
+        first_poll = not known and not RSS_reader_Entry.select().where(RSS_reader_Entry.feed == self.properties).exists()
+        send_updates = self.config.get('send-updates', False)
+
+        entries = list()
+        self._pending_entries = dict()      # id(entry) -> index row, written with the post of the entry
+        for key, (entry, content_hash) in current.items():
+            row = {'feed': self.properties.id, 'key': key, 'content_hash': content_hash, 'seen': now}
+            if first_poll:
+                # the index of a source is empty at its first poll, or after upgrading from date checks
+                new = self.properties.last_post_date is not None and self._published_after(entry, self.properties.last_post_date)
+            elif key not in known:
+                new = True
+            else:
+                new = known[key] != content_hash and send_updates
+                if new:
+                    self.logger.debug("%s: entry changed: %s", self.name, entry.get('link'))
+            if new:
+                entries.append(entry)
+                self._pending_entries[id(entry)] = row
+            else:
+                self._seen.append(row)
+        self.logger.debug("%s: %d entries, %d new", self.name, len(current), len(entries))
+        ENTRIES.inc(len(entries))
+        return entries
+
+    @staticmethod
+    def _published_after(entry, date: datetime) -> bool:
+        published = entry.get('published_parsed') or entry.get('updated_parsed')
+        return published is not None and convert_date(published) > date
+
+
+class Parser(ParserModel):
+    def __init__(self, config):
+        super().__init__(config)
+        self.logger = getLogger('RSS-reader')
+        self.logger.info('Initializing RSS reader plugin...')
+        self.timeout = self.config.get('timeout', 30)
+        # one pooled keep-alive session for feed polling and media checks, shared by all feeds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.config.get('connections', 8), max_retries=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._async_session = None
+        self.render_pool = ThreadPoolExecutor(self.config.get('render-workers', 4), thread_name_prefix='render')
+        self.render_ahead = self.config.get('render-ahead', 8)     # posts rendered before they are queued
+        probe_config = self.config.get('media-probe', {})
+        self.media_probe = MediaProbe(self.session,
+            timeout=probe_config.get('timeout', 10),
+            ttl=probe_config.get('ttl', 3600),
+            failure_ttl=probe_config.get('failure-ttl', 300),
+            workers=self.config.get('connections', 8),
+        )
+
+        # "sources" items are a source URL or a dict of per-feed config overriding the parser config
+        sources = self.config.get('sources') or [self.config['source']]
+        feed_configs = list()
+        for source in sources:
+            if isinstance(source, str):
+                source = {'source': source}
+            feed_config = {k:v for k,v in self.config.items() if k not in ('source', 'sources')}
+            feed_config.update(source)
+            feed_configs.append(feed_config)
+        # states of all feeds are read with one query, the missing ones are created in one transaction
+        states = dict()
+        for properties in RSS_reader_Data.select().order_by(RSS_reader_Data.id):
+            states.setdefault(properties.source, properties)
+        self.feeds = list()
+        with db_proxy.atomic():
+            for feed_config in feed_configs:
+                properties = states.get(feed_config['source'])
+                if created := properties is None:
+                    properties = states[feed_config['source']] = RSS_reader_Data.create(source=feed_config['source'])
+                self.feeds.append(Feed(self, feed_config, properties, created))
+
+    def sources(self):
+        return self.feeds
+
+    def new_posts(self):
+        messages = list()
+        for feed in self.feeds:
+            messages.extend(feed.new_posts() or [])
         return messages
 
     # TAG: ATTRIBUTE(S). attribute could be None | list | str | tuple
@@ -84,9 +341,29 @@ class Parser(ParserModel):
 
     SAFE_TAGS_ATTRS = {x:((y,) if isinstance(y,str) else y) for x,y in SAFE_TAGS_ATTRS.items()} # convert all str attributes to tuples
 
-    def render_post(self, post):
-        messages = []
-        template = self.config.get('post-template');
+    def async_session(self):
+        """aiohttp session of the async runtime, created on first use inside the event loop"""
+        if self._async_session is None:
+            aiohttp = import_aiohttp()
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.config.get('connections', 8)),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._async_session
+
+    async def close_async(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    def render_post(self, post, template:str = None, probes:dict = None):
+        fragments = self.prepare_post(post, template)
+        return self.render_fragments(fragments, post.link, probes)
+
+    def prepare_post(self, post, template:str = None) -> list:
+        """Format the post with the template and sanitize it, returns a list of HTML fragments and medias"""
+        if template is None:
+            template = self.config.get('post-template')
         feed = {
             "title":post.title,
             "content":post.description,     # TODO: make it soft coded!
@@ -99,126 +376,83 @@ class Parser(ParserModel):
             return []
         if not content:
             return []
+        with RENDER_SECONDS.time(stage='sanitize'):
+            return sanitize(content, self.SAFE_TAGS_ATTRS)
+
+    def probe_media(self, fragments:list) -> dict:
+        """Check all media of a post concurrently, returns a {url: ProbeResult} dict"""
+        with RENDER_SECONDS.time(stage='probe'):
+            return self.media_probe.probe_many(f.src for f in fragments if isinstance(f, Media))
+
+    async def probe_media_async(self, fragments:list) -> dict:
+        with RENDER_SECONDS.time(stage='probe'):
+            return await self.media_probe.probe_many_async((f.src for f in fragments if isinstance(f, Media)), self.async_session())
+
+    def render_fragments(self, fragments:list, link:str, probes:dict = None):
+        """
+        Convert the prepared post to messages. `probes` are results of `probe_media`, by default media are
+        checked here.
+        """
+        if probes is None:
+            probes = self.probe_media(fragments)
+        with RENDER_SECONDS.time(stage='render'):
+            return self._messages(fragments, link, probes)
 
-        body = self.purge_html(content)
-        medias = list(body('img'))+list(body('video'))
-        first = True
-        if medias:
-            before, after = None, str(body)
-
-            for media in medias:
-                split_by = str(media)
-                link = None
-                if media.parent.name == 'a':
-                    split_by = str(media.parent)
-                    link = media.parent['href']
-                before,after = after.split(split_by,1)
-                if before:
-                    if first:
-                        before, broken = self.summarize(Soup(before, 'html.parser'), TextMessage.MAX_LENGTH)
-                        messages.append(TextMessage(str(before),ParseMode.HTML))
-                        first = False
-                    else:
-                        before, broken = self.summarize(Soup(before, 'html.parser'), PhotoMessage.MAX_LENGTH)
-                        messages[-1].text = str(before)
+    def _messages(self, fragments:list, link:str, probes:dict):
+        messages = []
+        broken = False
+        for fragment in fragments:
+            if isinstance(fragment, str):
+                last = messages[-1] if messages else None
+                if isinstance(last, (PhotoMessage, VideoMessage)) and last.text is None:
+                    # text after a media is its caption
+                    last.text, broken = truncate_html(fragment, type(last).MAX_LENGTH)
+                else:
+                    text, broken = truncate_html(fragment, TextMessage.MAX_LENGTH)
+                    messages.append(TextMessage(text, ParseMode.HTML))
                 if broken:
                     # if last message is broken and has read more so stop adding more messages
                     break
-                if media.name == 'img':
-                    self.logger.debug('found image: %s',media['src'])
-                    if link:
-                        messages.append(PhotoMessage(media['src'], parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open image link',url=link)]]))
-                    else:
-                        messages.append(PhotoMessage(media['src'], parse_mode=ParseMode.HTML))
-                elif media.name == 'video':
-                    video_src = ''
-                    if 'src' in media.attrs:
-                        video_src = media['src']
-                    elif getattr(media, 'source', None) is not None:
-                        video_src = media.source['src']
-                    headers=requests.head(video_src).headers
-                    downloadable = 'attachment' in headers.get('Content-Disposition', '')
-                    self.logger.debug('found %s video: %s', 'downloadable' if downloadable else 'not downloadable', video_src)
-                    if not downloadable:
-                        messages.append(TextMessage('Video is not downloadable'), parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open video link',url=video_src)]])
-                        continue
-                    if link:
-                        messages.append(VideoMessage(video_src, parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open video link',url=link)]]))
-                    else:
-                        messages.append(VideoMessage(video_src, parse_mode=ParseMode.HTML))
-        else:
-            before, broken = self.summarize(body, TextMessage.MAX_LENGTH)
-            if before:
-                messages.append(TextMessage(str(before),ParseMode.HTML))
+            elif fragment.kind == 'img':
+                self.logger.debug('found image: %s', fragment.src)
+                probe = probes.get(fragment.src)
+                if probe is not None and not probe.fits('img'):
+                    # unreachable images are still sent, a failed HEAD doesn't mean Telegram can't download them
+                    messages.append(TextMessage('Image is too large', parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open image link',url=fragment.src)]]))
+                    continue
+                if fragment.link:
+                    messages.append(PhotoMessage(fragment.src, parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open image link',url=fragment.link)]]))
+                else:
+                    messages.append(PhotoMessage(fragment.src, parse_mode=ParseMode.HTML))
+            elif fragment.kind == 'video':
+                video_src = fragment.src
+                probe = probes.get(video_src) or self.media_probe.probe(video_src)
+                downloadable = probe.downloadable('video')
+                self.logger.debug('found %s video: %s', 'downloadable' if downloadable else 'not downloadable', video_src)
+                if not downloadable:
+                    messages.append(TextMessage('Video is too large' if not probe.fits('video') else 'Video is not downloadable', parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open video link',url=video_src)]]))
+                    continue
+                if fragment.link:
+                    messages.append(VideoMessage(video_src, parse_mode=ParseMode.HTML, inline_keyboard=[[InlineKeyboardButton('Open video link',url=fragment.link)]]))
+                else:
+                    messages.append(VideoMessage(video_src, parse_mode=ParseMode.HTML))
 
+        messages = group_media(messages)
         if len(messages) > 0:
             last_message = messages[-1]
-            if last_message.inline_keyboard is not None:
-                last_message.inline_keyboard.append([InlineKeyboardButton('Read more',url=post.link)])
+            if isinstance(last_message, MediaGroupMessage):
+                # albums can't have a keyboard, the link goes to the album caption
+                first = last_message.media[0]
+                read_more = f'<a href="{escape(link)}">Read more</a>'
+                first.text = f'{first.text}\n{read_more}' if first.text else read_more
+                first.parse_mode = ParseMode.HTML
+            elif last_message.inline_keyboard is not None:
+                last_message.inline_keyboard.append([InlineKeyboardButton('Read more',url=link)])
             else:
-                last_message.inline_keyboard = [[InlineKeyboardButton('Read more',url=post.link)]]
+                last_message.inline_keyboard = [[InlineKeyboardButton('Read more',url=link)]]
         
         return messages
 
-    def purge_html(self, html:str):
-        """
-        Remove all unsupported tags and attributes from html
-        """
-
-        soup = Soup(html, 'html.parser')
-        self.logger.debug('purging html...')
-        poor_html = ''.join(map(str,self.__purge_tag_rec(soup.contents)))
-        return Soup(poor_html, 'html.parser')
-
-    def __purge_tag_rec(self, children):    #recursive tag purging
-        self.logger.debug('children: %s',repr(children))
-        for tag in children:
-            self.logger.debug('checking tag: %s',repr(tag))
-            if getattr(tag, 'contents', None) is not None:
-                self.__purge_tag_rec(tag.contents)
-                if not tag.name in self.SAFE_TAGS_ATTRS:
-                    self.logger.debug('replacing tag %s with %s',repr(tag),''.join(map(str,tag.contents)))
-                    tag.replace_with(''.join(map(str,tag.contents)))
-                else:
-                    self.logger.debug('tag %s is safe',tag.name)
-                    attr = self.SAFE_TAGS_ATTRS[tag.name]
-                    if attr is None:
-                        tag.attrs.clear()
-                    elif isinstance(attr, tuple):
-                        if all(a in tag.attrs for a in attr):
-                            tag.attrs={a:tag[a] for a in attr}
-                        else:
-                            tag.replace_with(''.join(map(str,tag.contents)))
-                    elif isinstance(attr, list):
-                        tag.attrs = {a:tag[a] for a in attr if a in tag.attrs}
-            else:
-                self.logger.debug('not changing: %s',tag.string)
-        return children
-
-    def summarize(self, post_content:Soup, max_length = TextMessage.MAX_LENGTH, read_more = '...'):
-        trim = len(read_more)
-        len_ = len(str(post_content))
-        if len_>max_length:
-            trim += len_ - max_length
-            removed = 0
-            for element in reversed(list(post_content.descendants)):
-                if (not element.name) and len(str(element))>trim-removed:
-                    # if element is text and it's length is greater than trim
-                    # then we should break it
-                    s = str(element)
-                    break_from = s.rfind(' ',0 , trim-removed)
-                    element.replace_with(s[:-trim+removed if break_from==-1 else break_from])
-                    removed = trim
-                else:
-                    # if element is not text or it's length is less than trim
-                    # then we should remove it
-                    element.replace_with('')
-                    removed += len(str(element))
-                if removed >= trim:
-                    break
-            post_content.append(read_more)
-        return post_content, len_>max_length
-
     def last_post(self):
         self.logger.info("Getting last post...")
         raise NotImplemented() #TODO: Implement last_post
\ No newline at end of file
@@ -0,0 +1,154 @@
+# Single pass allowlist HTML sanitizer
+#
+# Converts feed HTML to Telegram-safe HTML while streaming over the tokens of html.parser, so the
+# cost is linear in the input size. Media tags are not supported by Telegram HTML, so they are
+# cut out of the text: the result is a list of safe HTML fragments and `Media` items in document order.
+# Tags that are open when a media splits the text are closed before it and opened again after it.
+from dataclasses import dataclass
+from html import escape
+from html.parser import HTMLParser
+
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+SKIP_CONTENT_TAGS = {'script', 'style', 'head', 'title', 'template', 'noscript'}
+
+
+@dataclass
+class Media:
+    kind: str           # 'img' or 'video'
+    src: str
+    link: str = None    # href of the anchor wrapping the media
+
+
+class _OpenTag:
+    __slots__ = ('name', 'markup', 'written', 'href')
+
+    def __init__(self, name, markup, href=None):
+        self.name = name
+        self.markup = markup
+        self.written = False    # the open tag is written lazily, so empty tags are never emitted
+        self.href = href
+
+
+class Sanitizer(HTMLParser):
+    def __init__(self, safe_tags_attrs: dict):
+        """
+        `safe_tags_attrs` maps tag names to None (no attributes), a tuple of required
+        attributes or a list of optional attributes. See `Parser.SAFE_TAGS_ATTRS`.
+        """
+        super().__init__(convert_charrefs=True)
+        self.safe_tags_attrs = safe_tags_attrs
+        self.fragments = list()
+        self._chunk = list()
+        self._stack = list()        # open safe tags
+        self._skip = None           # tag whose content is dropped, other tags inside it may be left unclosed
+        self._skip_depth = 0        # nesting of the `_skip` tag
+        self._video = None          # Media being built while inside <video>
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip is not None:
+            if tag == self._skip:
+                self._skip_depth += 1
+            elif tag == 'body' and self._skip == 'head':
+                self._skip = None   # an unclosed head ends where the body starts
+            return
+        if tag in SKIP_CONTENT_TAGS:
+            self._skip, self._skip_depth = tag, 1
+            return
+        attrs = dict(attrs)
+        if self._video is not None:
+            if tag == 'source' and not self._video.src and attrs.get('src'):
+                self._video.src = attrs['src']
+            return
+        if tag == 'img':
+            if attrs.get('src'):
+                self._add_media(Media('img', attrs['src'], self._link()))
+            return
+        if tag == 'video':
+            self._video = Media('video', attrs.get('src'), self._link())
+            return
+        if tag in VOID_TAGS or tag not in self.safe_tags_attrs:
+            return      # unsafe tags are unwrapped, their content is kept
+
+        allowed = self.safe_tags_attrs[tag]
+        if isinstance(allowed, tuple):
+            if not all(attrs.get(a) is not None for a in allowed):
+                return
+            kept = allowed
+        elif isinstance(allowed, list):
+            kept = [a for a in allowed if attrs.get(a) is not None]
+        else:
+            kept = ()
+        markup = ''.join(['<', tag] + [f' {a}="{escape(attrs[a])}"' for a in kept] + ['>'])
+        self._stack.append(_OpenTag(tag, markup, attrs.get('href') if tag == 'a' else None))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self._skip is not None:
+            if tag == self._skip:
+                self._skip_depth -= 1
+                if not self._skip_depth:
+                    self._skip = None
+            return
+        if tag == 'video':
+            if self._video is not None:
+                video, self._video = self._video, None
+                if video.src:
+                    self._add_media(video)
+            return
+        if tag in VOID_TAGS or self._video is not None:
+            return
+        # close the tag and every tag left open inside it, ignore stray end tags
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i].name == tag:
+                for open_tag in reversed(self._stack[i:]):
+                    if open_tag.written:
+                        self._chunk.append(f'</{open_tag.name}>')
+                del self._stack[i:]
+                return
+
+    def handle_data(self, data):
+        if self._skip is not None or self._video is not None or not data:
+            return
+        for open_tag in self._stack:
+            if not open_tag.written:
+                self._chunk.append(open_tag.markup)
+                open_tag.written = True
+        self._chunk.append(escape(data, quote=False))
+
+    def close(self):
+        super().close()
+        if self._video is not None and self._video.src:
+            self._add_media(self._video)
+        self._video = None
+        self._flush()
+        return self.fragments
+
+    def _link(self):
+        for open_tag in reversed(self._stack):
+            if open_tag.href is not None:
+                return open_tag.href
+
+    def _add_media(self, media: Media):
+        self._flush()
+        self.fragments.append(media)
+
+    def _flush(self):
+        for open_tag in reversed(self._stack):
+            if open_tag.written:
+                self._chunk.append(f'</{open_tag.name}>')
+                open_tag.written = False
+        html = ''.join(self._chunk)
+        self._chunk = list()
+        if html.strip():
+            self.fragments.append(html)
+
+
+def sanitize(html: str, safe_tags_attrs: dict) -> list:
+    """Returns a list of Telegram-safe HTML strings and `Media` items"""
+    sanitizer = Sanitizer(safe_tags_attrs)
+    sanitizer.feed(html)
+    return sanitizer.close()
@@ -0,0 +1,71 @@
+# Helpers for Telegram HTML formatted text
+#
+# Telegram limits the length of a message text or caption after parsing its entities: tags are not counted,
+# HTML entities count as the character they represent and the length is measured in UTF-16 code units.
+import re
+from html import escape, unescape
+
+_TOKENS = re.compile(r'<[^>]*>|[^<]+')
+
+
+def visible_length(text: str) -> int:
+    """Length of plain text as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _cut(text: str, units: int) -> str:
+    """The longest prefix of `text` that fits in `units` UTF-16 code units, preferably ending at a word boundary"""
+    encoded = text.encode('utf-16-le')[:units * 2]
+    if len(encoded) >= 2 and 0xD8 <= encoded[-1] <= 0xDB:
+        encoded = encoded[:-2]      # don't split a surrogate pair
+    cut = encoded.decode('utf-16-le')
+    if len(cut) < len(text) and not text[len(cut)].isspace():
+        space = max(cut.rfind(' '), cut.rfind('\n'))
+        if space != -1:
+            cut = cut[:space]
+    return cut.rstrip()
+
+
+def truncate_html(html: str, max_length: int, read_more: str = '...') -> tuple[str, bool]:
+    """
+    Truncate well formed Telegram HTML (e.g. sanitizer output) to `max_length` visible characters, cutting
+    at a word boundary and closing the tags left open. Returns the HTML and whether it was truncated.
+    """
+    tokens = _TOKENS.findall(html)
+    total = 0
+    for token in tokens:
+        if token[0] != '<':
+            total += visible_length(unescape(token))
+    if total <= max_length:
+        return html, False
+
+    budget = max_length - visible_length(read_more)
+    output = list()
+    stack = list()      # (tag name, index of the open tag in output)
+    for token in tokens:
+        if token[0] == '<':
+            if token.startswith('</'):
+                if stack:
+                    stack.pop()
+            elif not token.endswith('/>'):
+                stack.append((token[1:-1].split(None, 1)[0], len(output)))
+            output.append(token)
+            continue
+        text = unescape(token)
+        length = visible_length(text)
+        if length <= budget:
+            output.append(token)
+            budget -= length
+            continue
+        if (cut := _cut(text, budget)):
+            output.append(escape(cut, quote=False))
+        break
+
+    # close open tags, tags that got no content are removed instead
+    for name, index in reversed(stack):
+        if len(output) == index + 1:
+            del output[index]
+        else:
+            output.append(f'</{name}>')
+    output.append(escape(read_more, quote=False))
+    return ''.join(output), True
@@ -0,0 +1,67 @@
+# Plugin registry
+#
+# Plugins are found by their `plugin.jsonc` metadata file, e.g. plugins/parser/rss/plugin.jsonc. Listing
+# and checking them doesn't import their code, just the selected plugin is imported when it's loaded.
+# Directories with a plugin.py and no metadata (plugins written before it) are plugins named after the directory.
+import importlib
+import importlib.util
+import jstyleson
+from dataclasses import dataclass, field
+from logging import getLogger
+from os import listdir
+from os.path import dirname, isfile, join as path_join
+
+PLUGINS_DIR = dirname(__file__)
+METADATA_FILE = 'plugin.jsonc'
+DEFAULT_MODULE = 'plugin'
+
+
+@dataclass
+class PluginInfo:
+    kind: str                   # "parser"
+    name: str                   # the name used in the config, the directory by default
+    directory: str
+    module: str = DEFAULT_MODULE
+    description: str = ''
+    requires: list = field(default_factory=list)
+
+    @property
+    def import_name(self) -> str:
+        return '.'.join(['plugins', self.kind, self.directory, self.module])
+
+    def missing(self) -> list:
+        """Required modules that are not installed"""
+        return [name for name in self.requires if importlib.util.find_spec(name) is None]
+
+    def load(self):
+        """Import the module of the plugin"""
+        if missing := self.missing():
+            raise ImportError(f"{self.kind} plugin {self.name} requires {', '.join(missing)}")
+        return importlib.import_module(self.import_name)
+
+
+def discover(kind: str) -> dict:
+    """Plugins of a kind by name"""
+    plugins = dict()
+    base = path_join(PLUGINS_DIR, kind)
+    for directory in sorted(listdir(base)):
+        path = path_join(base, directory, METADATA_FILE)
+        if not isfile(path):
+            if isfile(path_join(base, directory, DEFAULT_MODULE + '.py')):
+                getLogger('plugins').info('%s plugin %s has no %s, add one to describe it and list its requirements',
+                                          kind, directory, METADATA_FILE)
+                plugins[directory] = PluginInfo(kind, directory, directory)
+            continue
+        try:
+            with open(path) as file:
+                metadata = jstyleson.load(file)
+        except ValueError as e:
+            getLogger('plugins').error('Invalid metadata of %s plugin %s: %s', kind, directory, e)
+            continue
+        info = PluginInfo(kind, metadata.get('name', directory), directory,
+            module=metadata.get('module', DEFAULT_MODULE),
+            description=metadata.get('description', ''),
+            requires=metadata.get('requires', []),
+        )
+        plugins[info.name] = info
+    return plugins
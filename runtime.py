@@ -0,0 +1,37 @@
+# Async runtime
+#
+# One asyncio event loop running in a background thread. Feed polling, media checks and message delivery
+# share it, so waiting for the network doesn't hold a thread. Blocking parts (database, sync parser plugins)
+# run in the loop's default executor. python-telegram-bot's Updater keeps its own threads for updates.
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Thread
+
+
+def import_aiohttp():
+    """aiohttp is just required by this runtime, it is imported on first use because importing it takes long"""
+    try:
+        import aiohttp
+    except ImportError:
+        raise RuntimeError('aiohttp is required for the async runtime') from None
+    return aiohttp
+
+class AsyncRuntime:
+    def __init__(self, executor_workers: int = 8):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(executor_workers, thread_name_prefix='executor'))
+        self._thread = Thread(target=self._run, name='asyncio', daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, coroutine) -> Future:
+        """Run a coroutine on the loop from another thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
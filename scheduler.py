@@ -0,0 +1,167 @@
+# Heap based scheduler that polls many sources with a bounded thread pool
+#
+# Every source has its own next poll time. Polls are spread with random jitter so sources with the
+# same interval don't all fire together, and with adaptive intervals a source is polled more often
+# while it publishes frequently and less often while it is quiet.
+import asyncio
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from logging import getLogger
+from random import uniform
+from threading import Condition, Thread
+from time import monotonic
+import metrics
+
+POLL_DELAY = metrics.histogram('scheduler_poll_delay_seconds', 'How late polls start after their scheduled time')
+POLL_SECONDS = metrics.histogram('scheduler_poll_seconds', 'Duration of source polls including queueing posts')
+
+
+class _Entry:
+    __slots__ = ('source', 'interval', 'last_update')
+
+    def __init__(self, source, interval):
+        self.source = source
+        self.interval = interval        # current interval, changes when adaptive
+        self.last_update = None         # monotonic time of the last poll that found new posts
+
+
+class Scheduler:
+    def __init__(self, poll: callable, default_interval: callable, workers: int = 4, jitter: float = 0.1,
+                 adaptive: bool = False, min_interval: float = 30, max_interval: float = 3600):
+        """
+        `poll(source)` is called from the pool and returns True when the source had new posts.
+        `default_interval()` is used for sources without their own interval.
+        `jitter` is the fraction of the interval that is randomly added or removed from every delay.
+        """
+        self.poll = poll
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.adaptive = adaptive
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.logger = getLogger('scheduler')
+        self.workers = workers
+        self._pool = None
+        self._heap = list()     # (due, seq, entry)
+        self._seq = count()
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='scheduler', daemon=True)
+
+    def add(self, source, delay: float = None):
+        """Schedule a source, by default its first poll happens at a random time in the first jitter window"""
+        entry = _Entry(source, self._base_interval(source))
+        if delay is None:
+            delay = uniform(0, entry.interval * self.jitter)
+        self._push(entry, delay)
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='poll')
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def _base_interval(self, source):
+        return source.interval or self.default_interval()
+
+    def _push(self, entry: _Entry, delay: float):
+        with self._cond:
+            heapq.heappush(self._heap, (monotonic() + delay, next(self._seq), entry))
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._heap or self._heap[0][0] > monotonic()):
+                    self._cond.wait(self._heap[0][0] - monotonic() if self._heap else None)
+                if self._stopped:
+                    return
+                due, seq, entry = heapq.heappop(self._heap)
+            # a source is not in the heap while it is polled, so it is never polled twice at once
+            self._pool.submit(self._poll, entry, due)
+
+    def _poll(self, entry: _Entry, due: float):
+        started = monotonic()
+        POLL_DELAY.observe(started - due)     # includes waiting for a free worker
+        updated = False
+        try:
+            updated = bool(self.poll(entry.source))
+        except Exception:
+            self.logger.exception('Polling %s failed', entry.source.name)
+        POLL_SECONDS.observe(monotonic() - started)
+        self._adapt(entry, updated, started)
+        self._push(entry, self._next_delay(entry))
+
+    def _next_delay(self, entry: _Entry) -> float:
+        delay = entry.interval * (1 + uniform(-self.jitter, self.jitter))
+        self.logger.debug('%s: next poll in %.0f seconds', entry.source.name, delay)
+        return delay
+
+    def _adapt(self, entry: _Entry, updated: bool, now: float):
+        base = self._base_interval(entry.source)
+        if not self.adaptive:
+            entry.interval = base
+            return
+        if updated:
+            if entry.last_update is not None:
+                # poll about twice per observed publishing gap
+                entry.interval = (entry.interval + (now - entry.last_update) / 2) / 2
+            entry.last_update = now
+        else:
+            entry.interval *= 1.25
+        entry.interval = min(max(entry.interval, self.min_interval), max(self.max_interval, base))
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Scheduler of the async runtime, every source is polled by a task of the event loop and `poll` is a
+    coroutine function. At most `workers` polls run at the same time.
+    """
+
+    def __init__(self, poll: callable, default_interval: callable, loop: asyncio.AbstractEventLoop, **kwargs):
+        super().__init__(poll, default_interval, **kwargs)
+        self.loop = loop
+        self._pending = list()      # (entry, delay) added before start
+        self._tasks = list()
+        self._semaphore = None
+
+    def add(self, source, delay: float = None):
+        entry = _Entry(source, self._base_interval(source))
+        if delay is None:
+            delay = uniform(0, entry.interval * self.jitter)
+        if self._semaphore is None:
+            self._pending.append((entry, delay))
+        else:
+            self._tasks.append(asyncio.run_coroutine_threadsafe(self._poll_loop(entry, delay), self.loop))
+
+    def start(self):
+        self._semaphore = asyncio.Semaphore(self.workers)
+        for entry, delay in self._pending:
+            self._tasks.append(asyncio.run_coroutine_threadsafe(self._poll_loop(entry, delay), self.loop))
+        self._pending.clear()
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _poll_loop(self, entry: _Entry, delay: float):
+        while True:
+            due = monotonic() + delay
+            await asyncio.sleep(delay)
+            async with self._semaphore:
+                started = monotonic()
+                POLL_DELAY.observe(started - due)
+                updated = False
+                try:
+                    updated = bool(await self.poll(entry.source))
+                except Exception:
+                    self.logger.exception('Polling %s failed', entry.source.name)
+            POLL_SECONDS.observe(monotonic() - started)
+            self._adapt(entry, updated, started)
+            delay = self._next_delay(entry)
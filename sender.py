@@ -0,0 +1,212 @@
+# Sends pre-serialised messages to the Bot API
+#
+# Messages are posted as their cached JSON payload (see `MessageModel.payload`) instead of going through
+# `telegram.Bot` methods, which would build and serialise the same request again for every chat.
+# Media are sent by URL once, then by the file_id remembered in the media cache.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import perf_counter
+from telegram import Bot
+from telegram.error import BadRequest, Conflict, InvalidToken, NetworkError, TelegramError, Unauthorized
+from telegram.utils.request import Request, Timeout
+import metrics
+from delivery import Resend
+from media_cache import MediaCache
+from plugins.parser.model import MessageModel, MediaGroupMessage
+from runtime import import_aiohttp
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+# read timeouts of the telegram.Bot methods, Telegram downloads the media URL before it answers these.
+# Other methods use the read timeout of the bot's Request.
+READ_TIMEOUTS = {'sendPhoto': 20, 'sendVideo': 20, 'sendMediaGroup': 20}
+
+# BadRequest descriptions of a media that can't be sent by its cached file_id
+FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'failed to get http url content',
+                  'wrong type of the web page content', 'file reference')
+
+
+def is_file_id_error(error: BadRequest) -> bool:
+    message = error.message.lower()
+    return any(text in message for text in FILE_ID_ERRORS)
+
+SEND_SECONDS = metrics.histogram('bot_api_request_seconds', 'Bot API send requests latency', labels=('method',))
+SENDS = metrics.counter('bot_api_requests_total', 'Bot API send requests by result', labels=('method', 'result'))
+
+
+def parse_response(status: int, data: bytes):
+    """Result of a Bot API response, errors are raised as telegram.error exceptions like python-telegram-bot does"""
+    if 200 <= status <= 299:
+        return Request._parse(data)
+    try:
+        message = str(Request._parse(data))
+    except ValueError:
+        message = 'Unknown HTTPError'
+    if status in (401, 403):
+        raise Unauthorized(message)
+    if status == 400:
+        raise BadRequest(message)
+    if status == 404:
+        raise InvalidToken()
+    if status == 409:
+        raise Conflict(message)
+    raise NetworkError(f'{message} ({status})')
+
+
+class Sender:
+    def __init__(self, bot: Bot, media_cache: MediaCache, proxy: str = None, connections: int = 100, workers: int = 8):
+        """`workers` is the number of delivery workers, `send_async` keeps a media cache thread for each of them"""
+        self.bot = bot
+        self.media_cache = media_cache
+        self.proxy = proxy
+        self.connections = connections
+        self.logger = getLogger('sender')
+        self._session = None
+        self._aiohttp = None
+        self._media_executor = None
+        self.workers = workers
+
+    def request(self, method: str, body: bytes):
+        """Post a pre-serialised JSON request with the bot's connection pool"""
+        request = self.bot.request
+        kwargs = dict()
+        if (read_timeout := READ_TIMEOUTS.get(method)) is not None:
+            kwargs['timeout'] = Timeout(connect=request._connect_timeout, read=read_timeout)
+        started = perf_counter()
+        try:
+            data = request._request_wrapper('POST', f'{self.bot.base_url}/{method}', body=body, headers=JSON_HEADERS, **kwargs)
+            result = request._parse(data)
+        except Exception as e:
+            self._measure(method, started, type(e).__name__)
+            raise
+        self._measure(method, started, 'ok')
+        return result
+
+    async def close_async(self):
+        """Close the HTTP session of `send_async`, called on its event loop at exit"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._media_executor is not None:
+            self._media_executor.shutdown(wait=False)
+
+    @staticmethod
+    def _measure(method: str, started: float, result: str):
+        if metrics.registry.enabled:
+            SEND_SECONDS.observe(perf_counter() - started, method=method)
+            SENDS.inc(method=method, result=result)
+
+    async def request_async(self, method: str, body: bytes):
+        if self._session is None:
+            aiohttp = self._aiohttp = import_aiohttp()
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        started = perf_counter()
+        try:
+            try:
+                async with self._session.post(f'{self.bot.base_url}/{method}', data=body, headers=JSON_HEADERS, proxy=self.proxy) as response:
+                    data = await response.read()
+            except self._aiohttp.ClientError as e:
+                raise NetworkError(f'aiohttp {e}') from e
+            result = parse_response(response.status, data)
+        except Exception as e:
+            self._measure(method, started, type(e).__name__)
+            raise
+        self._measure(method, started, 'ok')
+        return result
+
+    def send(self, message: MessageModel, chat_id: int):
+        payload, uploading, cached = self._prepare(message)
+        try:
+            result = self.request(payload.method, payload.for_chat(chat_id))
+        except BadRequest as e:
+            self._failed(uploading)
+            if cached and is_file_id_error(e):
+                # the engine sends it again by URL, as a new request through its rate limits
+                self._forget(cached, e)
+                raise Resend() from e
+            raise
+        except:
+            self._failed(uploading)
+            raise
+        self._succeeded(message, uploading, result)
+        return result
+
+    async def send_async(self, message: MessageModel, chat_id: int):
+        # media cache may block (database, waiting for another upload), so it runs in threads. Every
+        # delivery task has one, a task waiting for an upload never holds the thread the upload needs.
+        loop = asyncio.get_running_loop()
+        if self._media_executor is None:
+            self._media_executor = ThreadPoolExecutor(self.workers, thread_name_prefix='media-cache')
+        if message.MEDIA_KEY is None and not isinstance(message, MediaGroupMessage):
+            payload, uploading, cached = message.payload(), (), ()
+        else:
+            payload, uploading, cached = await loop.run_in_executor(self._media_executor, self._prepare, message)
+        try:
+            result = await self.request_async(payload.method, payload.for_chat(chat_id))
+        except BadRequest as e:
+            self._failed(uploading)
+            if cached and is_file_id_error(e):
+                await loop.run_in_executor(self._media_executor, self._forget, cached, e)
+                raise Resend() from e
+            raise
+        except:
+            self._failed(uploading)
+            raise
+        if uploading:
+            await loop.run_in_executor(self._media_executor, self._succeeded, message, uploading, result)
+        return result
+
+    @staticmethod
+    def _media_urls(message: MessageModel) -> list:
+        if isinstance(message, MediaGroupMessage):
+            return [getattr(item, item.MEDIA_KEY) for item in message.media]
+        if message.MEDIA_KEY is not None:
+            return [getattr(message, message.MEDIA_KEY)]
+        return []
+
+    def _prepare(self, message: MessageModel):
+        """Returns the payload to send, URLs this send uploads and URLs sent by a cached file_id"""
+        urls = self._media_urls(message)
+        files, uploading, cached = list(), set(), set()
+        for url in urls:
+            file_id = None
+            # a URL repeated in an album is sent by URL, a second lookup would wait for this upload
+            if urls.count(url) == 1:
+                file_id = self.media_cache.lookup(url)
+                if file_id is None:
+                    uploading.add(url)
+                else:
+                    cached.add(url)
+            files.append(file_id or url)
+        if not cached:
+            return message.payload(), uploading, cached
+        media = tuple(files) if isinstance(message, MediaGroupMessage) else files[0]
+        return message.payload(media), uploading, cached
+
+    def _succeeded(self, message: MessageModel, uploading: set, result):
+        if not uploading:
+            return
+        try:
+            if isinstance(message, MediaGroupMessage):
+                file_ids = message.file_ids(result)
+            else:
+                file_ids = [message.file_id(result)]
+        except (KeyError, IndexError, TypeError) as e:
+            # the message is sent, just its media can't be cached
+            self.logger.warning('No file_id found in the result of %s: %r', message.METHOD, e)
+            file_ids = []
+        stored = set()
+        for url, file_id in zip(self._media_urls(message), file_ids):
+            if url in uploading:
+                self.media_cache.put(url, file_id)
+                stored.add(url)
+        self._failed(uploading - stored)
+
+    def _failed(self, uploading: set):
+        for url in uploading:
+            self.media_cache.release(url)
+
+    def _forget(self, cached: set, error: TelegramError):
+        for url in cached:
+            self.logger.warning('Cached file_id of %s rejected (%s), sending by URL', url, error)
+            self.media_cache.forget(url)
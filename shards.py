@@ -0,0 +1,124 @@
+# Shard leases of the delivery
+#
+# Outbox rows are partitioned by chat id into a fixed number of shards. Every delivery process (the bot
+# or a `worker.py`) keeps a heartbeat row and holds leases on about its fair share of the shards, so each
+# chat is served by exactly one process. Leases are renewed by a timer thread, so slow sends never let
+# them expire. Leases of a process that stops renewing them expire and are taken over, and processes give
+# back shards above their share when another one joins.
+from logging import getLogger
+from math import ceil
+from threading import Event, Lock, Thread
+from time import time
+from peewee import *
+
+db_proxy = DatabaseProxy()
+
+
+class ShardLease(Model):
+    shard = IntegerField(primary_key=True)
+    owner = CharField(null=True)
+    expires = FloatField(default=0)     # unix time
+
+    class Meta:
+        database = db_proxy
+        table_name = 'outbox_shard_lease'
+
+
+class DeliveryWorker(Model):
+    id = CharField(primary_key=True)
+    seen = FloatField()                 # unix time of the last heartbeat
+
+    class Meta:
+        database = db_proxy
+        table_name = 'outbox_worker'
+
+db_tables = [ShardLease, DeliveryWorker]
+
+
+def shard_of(chat_id, shards: int):
+    """Shard of a chat id, works for ids and SQL expressions (group ids are negative)"""
+    return ((chat_id % shards) + shards) % shards
+
+
+class ShardCoordinator:
+    def __init__(self, db: Database, shards: int, worker_id: str, lease_ttl: float = 120):
+        """
+        Leases last `lease_ttl` seconds and are renewed every quarter of it after `start`. A shard
+        is only given back by `heartbeat`, so calling it when nothing of the shards is in flight
+        guarantees that no other process sends to the same chats meanwhile.
+        """
+        self.db = db
+        self.shards = shards
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.owned = frozenset()
+        self.logger = getLogger('shards')
+        self._next_heartbeat = 0
+        self._lock = Lock()         # `owned` changes
+        self._stopped = Event()
+
+    def start(self):
+        Thread(target=self._renew_leases, name='shard-leases', daemon=True).start()
+
+    def _renew_leases(self):
+        while not self._stopped.wait(self.lease_ttl / 4):
+            try:
+                self.renew()
+            except Exception:
+                self.logger.exception('Renewing shard leases failed')
+
+    def due(self) -> bool:
+        return time() >= self._next_heartbeat
+
+    def renew(self):
+        """Extend the leases held now, without rebalancing"""
+        now = time()
+        with self._lock, self.db.atomic('IMMEDIATE'):
+            DeliveryWorker.insert(id=self.worker_id, seen=now).on_conflict_replace().execute()
+            if not self.owned:
+                return
+            ShardLease.update(expires=now + self.lease_ttl).where(
+                (ShardLease.owner == self.worker_id) & ShardLease.shard.in_(self.owned)).execute()
+            held = frozenset(shard for shard, in ShardLease.select(ShardLease.shard).where(ShardLease.owner == self.worker_id).tuples())
+            if lost := self.owned - held:
+                # just possible if this process stalled for longer than the lease
+                self.logger.warning('Lost the leases of %d shards', len(lost))
+                self.owned = self.owned & held
+
+    def heartbeat(self) -> frozenset:
+        """Renew leases and rebalance, returns the owned shards"""
+        now = time()
+        expires = now + self.lease_ttl
+        with self._lock, self.db.atomic('IMMEDIATE'):
+            ShardLease.insert_many([{'shard': shard} for shard in range(self.shards)]).on_conflict_ignore().execute()
+            DeliveryWorker.insert(id=self.worker_id, seen=now).on_conflict_replace().execute()
+            DeliveryWorker.delete().where(DeliveryWorker.seen < now - self.lease_ttl).execute()
+            fair_share = ceil(self.shards / DeliveryWorker.select().count())
+
+            owned = [shard for shard, in ShardLease.select(ShardLease.shard)
+                .where((ShardLease.owner == self.worker_id) & (ShardLease.expires >= now))
+                .order_by(ShardLease.shard).tuples()]
+            if len(owned) > fair_share:
+                released = owned[fair_share:]
+                owned = owned[:fair_share]
+                ShardLease.update(owner=None, expires=0).where(ShardLease.shard.in_(released)).execute()
+                self.logger.info('Released %d shards for other workers', len(released))
+            elif len(owned) < fair_share:
+                free = [shard for shard, in ShardLease.select(ShardLease.shard)
+                    .where(ShardLease.owner.is_null() | (ShardLease.expires < now))
+                    .order_by(ShardLease.shard).limit(fair_share - len(owned)).tuples()]
+                owned += free
+                if free:
+                    self.logger.info('Took %d shards', len(free))
+            if owned:
+                ShardLease.update(owner=self.worker_id, expires=expires).where(ShardLease.shard.in_(owned)).execute()
+            self.owned = frozenset(owned)
+        self._next_heartbeat = now + self.lease_ttl / 4
+        return self.owned
+
+    def release(self):
+        self._stopped.set()
+        with self._lock, self.db.atomic():
+            ShardLease.update(owner=None, expires=0).where(ShardLease.owner == self.worker_id).execute()
+            DeliveryWorker.delete().where(DeliveryWorker.id == self.worker_id).execute()
+        self.owned = frozenset()
@@ -0,0 +1,167 @@
+# Subscriber statistics
+#
+# Totals of chats and members per chat type and active state are kept in a small table that is updated
+# in the same transaction as the subscribers table, so reading them never scans the subscribers.
+# Member counts are refreshed by a background job in throttled batches.
+from datetime import datetime
+from logging import getLogger
+from threading import Event, Thread
+from time import sleep
+from peewee import *
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+
+db_proxy = DatabaseProxy()
+
+
+class ChatStats(Model):
+    type = CharField()
+    active = BooleanField()
+    chats = IntegerField(default=0)
+    members = IntegerField(default=0)
+
+    class Meta:
+        database = db_proxy
+        table_name = 'chat_stats'
+        indexes = (
+            (('type', 'active'), True),
+        )
+
+db_tables = [ChatStats]
+
+
+class Statistics:
+    def __init__(self, db: Database, chat_model):
+        """
+        `chat_model` is the subscribers model, it must have `type`, `active` and `members_count` fields.
+        """
+        self.db = db
+        self.chat_model = chat_model
+        self.logger = getLogger('stats')
+
+    def rebuild(self):
+        """Compute all totals from the subscribers table"""
+        Chat = self.chat_model
+        with self.db.atomic():
+            ChatStats.delete().execute()
+            totals = Chat.select(Chat.type, Chat.active, fn.COUNT(Chat.id), fn.COALESCE(fn.SUM(Chat.members_count), 0)).group_by(Chat.type, Chat.active)
+            ChatStats.insert_from(totals, [ChatStats.type, ChatStats.active, ChatStats.chats, ChatStats.members]).execute()
+
+    def ensure(self):
+        """Build the totals if they are missing (first run or a new database)"""
+        if not ChatStats.select().exists() and self.chat_model.select().exists():
+            self.logger.info('Building subscriber statistics...')
+            self.rebuild()
+
+    def update(self, type: str, active: bool, chats: int = 0, members: int = 0):
+        """Add to the totals of a chat type and state, call it in the transaction that changes the chats"""
+        ChatStats.insert(type=type, active=active, chats=chats, members=members).on_conflict(
+            conflict_target=[ChatStats.type, ChatStats.active],
+            update={ChatStats.chats: ChatStats.chats + chats, ChatStats.members: ChatStats.members + members},
+        ).execute()
+
+    def chat_added(self, type: str, members: int, active: bool = True):
+        self.update(type, active, 1, members)
+
+    def chat_reactivated(self, type: str, members: int):
+        self.update(type, False, -1, -members)
+        self.update(type, True, 1, members)
+
+    def chats_deactivated(self, chats: list):
+        """`chats` are (type, members) of chats that were active"""
+        by_type = dict()
+        for type, members in chats:
+            count, total = by_type.get(type, (0, 0))
+            by_type[type] = (count + 1, total + members)
+        for type, (count, members) in by_type.items():
+            self.update(type, True, -count, -members)
+            self.update(type, False, count, members)
+
+    def totals(self) -> dict:
+        """{(type, active): (chats, members)}"""
+        return {(row.type, row.active): (row.chats, row.members) for row in ChatStats.select()}
+
+
+class MemberCountRefresher:
+    """Background job that refreshes member counts of the least recently refreshed chats in batches"""
+
+    def __init__(self, bot: Bot, db: Database, chat_model, statistics: Statistics,
+                 interval: float = 3600, batch_size: int = 100, rate: float = 5, max_age: float = 24 * 3600):
+        """
+        A batch is refreshed every `interval` seconds with at most `rate` requests per second.
+        Chats refreshed in the last `max_age` seconds are skipped.
+        """
+        self.bot = bot
+        self.db = db
+        self.chat_model = chat_model
+        self.statistics = statistics
+        self.interval = interval
+        self.batch_size = batch_size
+        self.rate = rate
+        self.max_age = max_age
+        self.logger = getLogger('stats')
+        self._wakeup = Event()
+
+    def start(self):
+        Thread(target=self._run, name='member-counts', daemon=True).start()
+
+    def wake(self):
+        """Refresh now, e.g. after a chat was registered without its member count"""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                refreshed = self.refresh()
+            except Exception:
+                self.logger.exception('Refreshing member counts failed')
+                refreshed = 0
+            # continue right away while there is a backlog
+            self._wakeup.wait(self.interval if refreshed < self.batch_size else 1 / self.rate)
+            self._wakeup.clear()
+
+    def refresh(self) -> int:
+        Chat = self.chat_model
+        threshold = datetime.fromtimestamp(datetime.now().timestamp() - self.max_age)
+        batch = list(Chat
+            .select(Chat.id, Chat.type, Chat.members_count)
+            .where((Chat.active == True) & (Chat.type != 'private')      # a private chat is always the user and the bot
+                & (Chat.members_updated.is_null() | (Chat.members_updated < threshold)))
+            .order_by(Chat.members_updated.asc(nulls='first'))
+            .limit(self.batch_size))
+        results = list()
+        for chat in batch:
+            try:
+                count = self.bot.get_chat_member_count(chat.id) - 1    # -1 for bot
+            except RetryAfter as e:
+                sleep(e.retry_after)
+                break
+            except TelegramError as e:
+                self.logger.debug('Member count of chat %d failed: %s', chat.id, e)
+                count = chat.members_count
+            results.append((chat, count))
+            sleep(1 / self.rate)
+        now = datetime.now()
+        counts = {chat.id: count for chat, count in results}
+        # the chats may have changed while counting (deactivated, migrated), the deltas are computed from
+        # their current rows. IMMEDIATE, a deferred transaction that reads first could not upgrade its lock
+        with self.db.atomic('IMMEDIATE'):
+            current = list()
+            for chunk in chunked(list(counts), 500):
+                current.extend(Chat.select(Chat.id, Chat.type, Chat.active, Chat.members_count).where(Chat.id.in_(chunk)).tuples())
+            deltas = dict()
+            unchanged = list()
+            for id, type, active, members_count in current:
+                count = counts[id]
+                if count == members_count:
+                    unchanged.append(id)
+                    continue
+                deltas[type, active] = deltas.get((type, active), 0) + count - members_count
+                Chat.update(members_count=count, members_updated=now).where(Chat.id == id).execute()
+            for chunk in chunked(unchanged, 500):
+                Chat.update(members_updated=now).where(Chat.id.in_(chunk)).execute()
+            for (type, active), delta in deltas.items():
+                self.statistics.update(type, active, members=delta)
+        if results:
+            self.logger.debug('Refreshed member counts of %d chats', len(results))
+        return len(results)
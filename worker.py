@@ -0,0 +1,93 @@
+# Delivery worker process
+#
+# Sends the outbox rows of the shards it leases, next to the bot (main.py) and other workers using the
+# same database. main.py starts `delivery.processes - 1` of them, more can be run by hand:
+#
+#   python worker.py
+import logging
+import os
+import signal
+import socket
+import jstyleson
+from os.path import exists
+from threading import Event
+from telegram import Bot
+from telegram.utils.request import Request
+from colored_log import ColoredLog
+from database import create_schema, open_database
+from delivery import DeliveryEngine
+from media_cache import MediaCache
+from sender import Sender
+from shards import ShardCoordinator
+import outbox as outbox_module
+import media_cache as media_cache_module
+import stats as stats_module
+import shards as shards_module
+import models
+from models import Chatdb
+
+CONFIG_FILE = "config.jsonc" if exists("config.jsonc") else "config.default.jsonc"
+
+config: dict = jstyleson.load(open(CONFIG_FILE))
+consoleHandler = logging.StreamHandler()
+consoleHandler.setFormatter(ColoredLog())
+logging.basicConfig(level=logging._nameToLevel.get(config.get('log-level', 'INFO').upper(), logging.INFO), handlers=[consoleHandler])
+logger = logging.getLogger('worker')
+
+sqlite_config = config.get('sqlite', {})
+db = open_database(config.get('database', 'database.sqlite'),
+    cache_size=sqlite_config.get('cache-size', 64000),
+    synchronous=sqlite_config.get('synchronous', 'normal'),
+    timeout=sqlite_config.get('timeout', 30),
+)
+for module in (outbox_module, media_cache_module, stats_module, shards_module, models):
+    module.db_proxy.initialize(db)
+db.connect()
+# the bot creates the tables too, whichever process starts first
+create_schema(db, models.db_tables + outbox_module.db_tables + media_cache_module.db_tables
+                  + stats_module.db_tables + shards_module.db_tables)
+
+delivery_config = config.get('delivery', {})
+processes = delivery_config.get('processes', 1)
+if processes == 1 and 'shards' not in delivery_config:
+    # the bot delivers every chat itself then
+    raise SystemExit("Set delivery.processes or delivery.shards in the config to run workers")
+shards = delivery_config.get('shards', 16 * processes)
+
+bot_api_url = config.get('bot-api-url')
+api_kwargs = dict(base_url=f'{bot_api_url}/bot', base_file_url=f'{bot_api_url}/file/bot') if bot_api_url else dict()
+request = Request(con_pool_size=delivery_config.get('workers', 8) + 4, proxy_url=config.get('proxy-url'))
+bot = Bot(config.get('token') or config.get('telegram-token'), request=request, **api_kwargs)
+
+media_cache_config = config.get('media-cache', {})
+media_cache = MediaCache(
+    max_size=media_cache_config.get('max-size', 1000),
+    ttl=media_cache_config.get('ttl', 30 * 24 * 3600),
+)
+sender = Sender(bot, media_cache, proxy=config.get('proxy-url'), workers=delivery_config.get('workers', 8))
+delivery = DeliveryEngine(sender.send,
+    workers=delivery_config.get('workers', 8),
+    global_rate=delivery_config.get('global-rate', 30) / processes,
+    chat_rate=delivery_config.get('chat-rate', 1),
+    report_interval=delivery_config.get('report-interval', 10),
+    retries=delivery_config.get('retries', 5),
+)
+coordinator = ShardCoordinator(db, shards, f'{socket.gethostname()}-{os.getpid()}', lease_ttl=delivery_config.get('lease-ttl', 120))
+outbox = outbox_module.Outbox(db, delivery, Chatdb,
+    batch_size=delivery_config.get('batch-size', 1000),
+    statistics=stats_module.Statistics(db, Chatdb),
+    shards=shards,
+    coordinator=coordinator,
+    poll_interval=delivery_config.get('poll-interval', 1),
+    retry_interval=delivery_config.get('retry-interval', 60),
+)
+
+stopped = Event()
+for signum in (signal.SIGINT, signal.SIGTERM):
+    signal.signal(signum, lambda *args: stopped.set())
+
+logger.info('Delivery worker %s started', coordinator.worker_id)
+outbox.start()
+stopped.wait()
+logger.info('Stopping, giving back %d shards', len(coordinator.owned))
+outbox.stop()